@@ -0,0 +1,406 @@
+from __future__ import with_statement
+
+from level_loader import read_level_cached, time_level_load
+from replay import CONTROL_STATES, Replay, load_replay
+from svg_paths import linearize_points, points_area, reverse_points, triangulate_points, triangulate_points_reference
+
+import json
+import math
+import os
+import random
+import resource
+import sys
+import timeit
+from array import array
+from optparse import OptionParser
+
+LEVEL_DIR = os.path.dirname(os.path.abspath(__file__))
+SHIPPED_LEVELS = ['level0.svg', 'falling_down.svg', 'race_of_spades.svg',
+                  'triangulation.svg', 'simple.svg']
+
+# Results
+
+# Units where a larger value is better. For all others, smaller is better.
+HIGHER_IS_BETTER = set(['steps/s'])
+
+class Results(object):
+    """ Named measurements, printed as they come in. """
+    def __init__(self):
+        self.values = {}
+
+    def add(self, name, value, unit):
+        self.values[name] = value, unit
+        print '%-44s %12.3f %s' % (name, value, unit)
+
+    def save(self, file_name):
+        with open(file_name, 'w') as f:
+            json.dump(self.values, f, indent=1, sort_keys=True)
+
+    def compare(self, baseline, threshold):
+        """
+        Returns the lines for the measurements that are more than
+        threshold (a fraction) worse than in baseline.
+        """
+        regressions = []
+        for name in sorted(self.values):
+            if name not in baseline:
+                continue
+            value, unit = self.values[name]
+            base = baseline[name][0]
+            if unit in HIGHER_IS_BETTER:
+                worse = value < base / (1 + threshold)
+            else:
+                worse = value > base * (1 + threshold)
+            if worse:
+                regressions.append('%s: %.3f %s, baseline %.3f' %
+                                   (name, value, unit, base))
+        return regressions
+
+def load_baseline(file_name):
+    with open(file_name) as f:
+        return json.load(f)
+
+def peak_memory_mb():
+    """ The peak resident size of this process so far. """
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Kilobytes on Linux, bytes on Mac OS X.
+    if sys.platform == 'darwin':
+        return peak / (1024.0 * 1024.0)
+    return peak / 1024.0
+
+def level_path(name):
+    return os.path.join(LEVEL_DIR, name)
+
+def describe_error(e):
+    if str(e):
+        return '%s: %s' % (type(e).__name__, e)
+    return type(e).__name__
+
+def best_time(f, repeat):
+    return min(timeit.repeat(f, number=1, repeat=repeat))
+
+# Synthetic input
+
+def cave_polygon(n, seed=0):
+    """
+    A simple, star shaped polygon with n vertices and a ragged outline,
+    similar to the cave walls in the levels. It is oriented the way the
+    level loader hands polygons to the triangulator.
+    """
+    rnd = random.Random(seed)
+    points = array('d')
+    for i in xrange(n):
+        angle = 2 * math.pi * i / n
+        radius = 100 * (1 + 0.4 * math.sin(7 * angle) + 0.3 * rnd.random())
+        points.extend((radius * math.cos(angle), radius * math.sin(angle)))
+    if points_area(points) > 0.0:
+        points = reverse_points(points)
+    return points
+
+def curve_path(n, seed=0):
+    """ A closed SVG path of n cubic curves around a ragged circle. """
+    rnd = random.Random(seed)
+    def point(angle):
+        radius = 100 * (1 + 0.3 * rnd.random())
+        return '%.3f,%.3f' % (radius * math.cos(angle),
+                              radius * math.sin(angle))
+    parts = ['M %s' % point(0.0)]
+    step = 2 * math.pi / n
+    for i in xrange(n):
+        angle = i * step
+        parts.append('C %s %s %s' % (point(angle + step / 3),
+                                     point(angle + 2 * step / 3),
+                                     point(angle + step)))
+    parts.append('z')
+    return ' '.join(parts)
+
+def force_field_level(n_bodies, n_forces):
+    """
+    A level as read_level returns it, with a ship, n_bodies boxes in a
+    row, and n_forces force fields spread over the boxes.
+    """
+    style = {'fill': '#808080'}
+    def rect(id, label, left, lower, width, height):
+        return (id, label, [('rect', id, label, style,
+                             ((left, lower), (width, height)))])
+    header = dict(width=20.0 * n_bodies + 100, height=200.0,
+                  winning_condition=['never'])
+    bodies = [('pagecolor', '#000000', None),
+              ('viewport', {}, [('rect', 'viewport', {}, style,
+                                 ((0, 0), (100, 100)))]),
+              rect('ship', {}, 10, 100, 4, 4)]
+    for i in xrange(n_bodies):
+        bodies.append(rect('box%d' % i, {}, 20.0 * i + 50, 50, 5, 5))
+    for i in xrange(n_forces):
+        label = {'applies_force': 'box%d' % (i % n_bodies),
+                 'multiplier': '0.1'}
+        bodies.append(('force%d' % i, label,
+                       [('path', 'force%d' % i, label, style,
+                         ((0, 0), (0, 1)))]))
+    return header, bodies
+
+def level_polygons(file_name):
+    """
+    The closed paths of a level, as the level loader hands them to the
+    triangulator.
+    """
+    header, bodies = read_level_cached(file_name)
+    polygons = []
+    for body in bodies:
+        if len(body) < 3 or not isinstance(body[2], list):
+            continue
+        for shape in body[2]:
+            if shape[0] != 'polygon':
+                continue
+            points = array('d')
+            for x, y in shape[4][:-1]:
+                points.extend((x, y))
+            if points_area(points) > 0.0:
+                points = reverse_points(points)
+            polygons.append(points)
+    return polygons
+
+def random_replay(steps, seed=0):
+    """ Controls held for random stretches, like a player's. """
+    rnd = random.Random(seed)
+    replay = Replay()
+    while len(replay) < steps:
+        control = rnd.choice(CONTROL_STATES)
+        for i in xrange(min(rnd.randint(5, 60), steps - len(replay))):
+            replay.append(*control)
+    return replay
+
+def stress_levels():
+    """ (name, level) pairs of synthetic levels for the sim benchmarks. """
+    return [('forces_1000', force_field_level(250, 1000))]
+
+# Benchmarks
+
+def bench_load(results, options):
+    for name in SHIPPED_LEVELS:
+        try:
+            cold, warm = time_level_load(level_path(name), options.repeat)
+        except Exception, e:
+            print '%-44s skipped: %s' % ('load.%s' % name, e)
+            continue
+        results.add('load.%s.parse' % name, cold * 1000, 'ms')
+        results.add('load.%s.cached' % name, warm * 1000, 'ms')
+
+def bench_paths(results, options):
+    for n in (10, 100, 1000):
+        path = curve_path(n)
+        t = best_time(lambda: linearize_points(path), options.repeat)
+        results.add('paths.linearize.%d_curves' % n, t * 1000, 'ms')
+
+def bench_triangulation(results, options):
+    sizes = [int(n) for n in options.sizes.split(',')]
+    for n in sizes:
+        polygon = cave_polygon(n)
+        fast = best_time(lambda: triangulate_points(polygon), options.repeat)
+        results.add('triangulation.%d' % n, fast * 1000, 'ms')
+        if n <= options.reference_limit:
+            reference = best_time(
+                lambda: triangulate_points_reference(polygon), 1)
+            print '%44s %12.1fx faster than the reference' % (
+                '', reference / fast)
+    # The polygons drawn to test the triangulator.
+    name = 'triangulation.svg'
+    polygons = level_polygons(level_path(name))
+    def triangulate_all():
+        for polygon in polygons:
+            triangulate_points(polygon)
+    results.add('triangulation.%s' % name,
+                best_time(triangulate_all, options.repeat) * 1000, 'ms')
+
+def sim_levels(options):
+    """ (name, level loader, replay) for the sim benchmarks. """
+    replay = random_replay(options.steps)
+    for name in SHIPPED_LEVELS:
+        yield name, lambda name=name: read_level_cached(level_path(name)), \
+              replay
+    for name, level in stress_levels():
+        yield name, lambda level=level: level, replay
+    for pair in options.replays:
+        level_file, replay_file = pair.split(':', 1)
+        yield ('%s+%s' % (os.path.basename(level_file),
+                          os.path.basename(replay_file)),
+               lambda level_file=level_file: read_level_cached(level_file),
+               load_replay(replay_file))
+
+def bench_sim(results, options):
+    from sim import LevelTemplate, headless
+
+    for name, load, replay in sim_levels(options):
+        # Levels without a ship, or with shapes Box2D cannot take, like
+        # triangulation.svg, cannot be played.
+        try:
+            template = LevelTemplate(*load())
+            template.make_sim(is_ghost=True)
+        except Exception, e:
+            print '%-44s skipped: %s' % ('sim.%s' % name, describe_error(e))
+            continue
+        best = None
+        for i in xrange(options.repeat):
+            # A ghost never ends the game, so every step of the replay runs.
+            sim, _, _, _ = template.make_sim(is_ghost=True)
+            t = timeit.default_timer()
+            headless(sim, replay)
+            t = timeit.default_timer() - t
+            rate = sim.steps_taken / t
+            best = rate if best is None else max(best, rate)
+        results.add('sim.%s' % name, best, 'steps/s')
+
+def bench_forces(results, options):
+    from sim import make_sim_from_level
+
+    for n in [int(n) for n in options.forces.split(',')]:
+        header, bodies = force_field_level(max(1, n // 4), n)
+        sim, _, _, _ = make_sim_from_level(header, bodies)
+        def run_apply():
+            for i in xrange(options.steps):
+                sim.apply_forces()
+        def run_step():
+            for i in xrange(options.steps):
+                sim.step()
+        apply_time = best_time(run_apply, options.repeat)
+        step_time = best_time(run_step, options.repeat)
+        results.add('forces.%d.apply_forces' % n,
+                    apply_time / options.steps * 1e6, 'us')
+        results.add('forces.%d.step' % n,
+                    step_time / options.steps * 1e6, 'us')
+
+def bench_render(results, options):
+    """ Frame times of WorldRenderer, in a hidden window. """
+    from sim import make_sim_from_level
+    import pyglet
+    # The window below is the only one, and without a display the shadow
+    # window would fail on import instead.
+    pyglet.options['shadow_window'] = False
+    import pyglet.window
+    from window import WorldRenderer
+    from pyglet.gl import GL_MODELVIEW, GL_PROJECTION, glFinish, \
+         glLoadIdentity, glMatrixMode, glOrtho
+
+    try:
+        window = pyglet.window.Window(width=400, height=400, visible=False)
+    except pyglet.window.NoSuchDisplayException, e:
+        print '%-44s skipped: %s' % ('render', e)
+        return
+    replay = list(random_replay(options.frames))
+    try:
+        for name, load, _ in sim_levels(options):
+            try:
+                header, bodies = load()
+                sim, viewport, _, _ = make_sim_from_level(header, bodies,
+                                                          is_ghost=True)
+            except Exception, e:
+                print '%-44s skipped: %s' % ('render.%s' % name,
+                                             describe_error(e))
+                continue
+            (x, y), (w, h) = viewport
+            view = x, y, x + w, y + h
+            renderer = WorldRenderer(sim, pixels_per_unit=400.0 / h)
+            glMatrixMode(GL_PROJECTION)
+            glLoadIdentity()
+            glOrtho(x, x + w, y, y + h, -1.0, 1.0)
+            glMatrixMode(GL_MODELVIEW)
+            times = []
+            vertices = culled = 0
+            for thrust, turn_direction in replay:
+                sim.ship.thrust = thrust
+                sim.ship.turn_direction = turn_direction
+                sim.step()
+                window.clear()
+                t = timeit.default_timer()
+                renderer.draw(view)
+                glFinish()
+                times.append(timeit.default_timer() - t)
+                vertices += renderer.vertex_count
+                culled += renderer.culled
+            times.sort()
+            results.add('render.%s.p50' % name,
+                        times[len(times) // 2] * 1000, 'ms')
+            results.add('render.%s.max' % name, times[-1] * 1000, 'ms')
+            results.add('render.%s.vertices' % name,
+                        vertices / float(len(times)), 'vertices/frame')
+            print '%44s %12.1f bodies/frame culled' % (
+                '', culled / float(len(times)))
+    finally:
+        window.close()
+
+BENCHMARKS = [('load', bench_load),
+              ('paths', bench_paths),
+              ('triangulation', bench_triangulation),
+              ('sim', bench_sim),
+              ('forces', bench_forces),
+              ('render', bench_render)]
+
+
+def main():
+    names = [name for name, bench in BENCHMARKS]
+    parser = OptionParser(usage='%%prog [options] [BENCHMARK...]\n\n'
+                          'Benchmarks: %s. The default is all of them; '
+                          'those whose dependencies are missing are '
+                          'skipped. benchmark_baseline.json holds results '
+                          'to compare with -b.' % ', '.join(names))
+    parser.add_option('-n', '--sizes', dest='sizes',
+                      default='10,50,100,250,500,1000,5000',
+                      help='Comma separated polygon sizes to triangulate.')
+    parser.add_option('--reference-limit', dest='reference_limit', type='int',
+                      default=500, metavar='N',
+                      help='Only time the reference triangulator up to N '
+                           'vertices.')
+    parser.add_option('-f', '--forces', dest='forces',
+                      default='10,100,1000',
+                      help='Comma separated force field counts to step.')
+    parser.add_option('--steps', dest='steps', type='int', default=1000,
+                      help='Steps per timed sim run.')
+    parser.add_option('--frames', dest='frames', type='int', default=300,
+                      help='Frames per level in the render benchmark.')
+    parser.add_option('-r', '--replay', dest='replays', action='append',
+                      default=[], metavar='LEVEL:REPLAY',
+                      help='Also run the sim and render benchmarks on a '
+                           'recorded replay. May be given several times.')
+    parser.add_option('--repeat', dest='repeat', type='int', default=5,
+                      help='Take the best of REPEAT runs.')
+    parser.add_option('-b', '--baseline', dest='baseline', metavar='FILE',
+                      help='Compare with the results in FILE, and exit with '
+                           'status 1 if any is worse by more than the '
+                           'threshold.')
+    parser.add_option('-t', '--threshold', dest='threshold', type='float',
+                      default=0.25,
+                      help='Allowed slowdown against the baseline, as a '
+                           'fraction. Default is 0.25.')
+    parser.add_option('-s', '--save', dest='save_file', metavar='FILE',
+                      help='Save the results to FILE, to be used as a '
+                           'baseline.')
+    options, args = parser.parse_args()
+    for name in args:
+        if name not in names:
+            parser.error('Unknown benchmark %s. ' % name)
+
+    results = Results()
+    for name, bench in BENCHMARKS:
+        if args and name not in args:
+            continue
+        try:
+            bench(results, options)
+        except ImportError, e:
+            print '%-44s skipped: %s' % (name, e)
+            continue
+        results.add('memory.peak_after_%s' % name, peak_memory_mb(), 'MB')
+
+    if options.save_file:
+        results.save(options.save_file)
+    if options.baseline:
+        regressions = results.compare(load_baseline(options.baseline),
+                                      options.threshold)
+        if regressions:
+            print
+            print 'Regressions against %s:' % options.baseline
+            for line in regressions:
+                print '  ' + line
+            sys.exit(1)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,194 @@
+from __future__ import with_statement
+
+from level_loader import LOADER_VERSION
+from replay import level_hash, load_replay
+from sim import SIM_VERSION, make_sim
+
+import hashlib
+import os
+import struct
+from array import array
+
+# A pose track is what a ghost needs to be drawn: the position and angle
+# of every moving body at every step of its replay. It is computed once
+# by running the replay headless, and cached next to the replay file.
+#
+# File layout, all little endian:
+#   magic 'FPGT', version (u8), loader version (u32), sim version (u32),
+#   sha1 of the level SVG (20 bytes), sha1 of the replay file (20 bytes),
+#   steps (u32), bodies (u32), the body ids as u16 length prefixed UTF-8,
+#   then steps * bodies * 3 floats (f32 x, y, angle), NaN where a body
+#   does not exist.
+# A track is only used if it was recorded with the current loader and
+# sim, since both change how a replay plays out.
+MAGIC = 'FPGT'
+VERSION = 2
+HEADER = struct.Struct('<4sBII20s20sII')
+TRACK_SUFFIX = '.track'
+
+NAN = float('nan')
+
+class PoseTrack(object):
+    def __init__(self, body_ids, poses):
+        self.body_ids = body_ids
+        self.poses = poses
+        self.steps = len(poses) // (3 * len(body_ids)) if body_ids else 0
+
+    def __len__(self):
+        return self.steps
+
+    def poses_between(self, steps_taken, alpha):
+        """
+        Yields (body index, x, y, angle) of the bodies after steps_taken
+        steps, interpolated alpha of the way from the step before. Frame i
+        of the track is the state after step i + 1. Steps after the end
+        of the track show the last one.
+        """
+        if not self.steps:
+            return
+        if steps_taken > self.steps:
+            alpha = 1.0
+        current = max(0, min(steps_taken - 1, self.steps - 1))
+        previous = max(0, current - 1)
+        n = len(self.body_ids)
+        poses = self.poses
+        offset = current * n * 3
+        previous_offset = previous * n * 3
+        for i in xrange(n):
+            j = offset + 3 * i
+            x = poses[j]
+            # NaN is the only value that is not equal to itself.
+            if x != x:
+                continue
+            y, angle = poses[j + 1], poses[j + 2]
+            k = previous_offset + 3 * i
+            px = poses[k]
+            if px == px and alpha < 1.0:
+                py, pangle = poses[k + 1], poses[k + 2]
+                x = px + (x - px) * alpha
+                y = py + (y - py) * alpha
+                angle = pangle + (angle - pangle) * alpha
+            yield i, x, y, angle
+
+    def write(self, file, level_hash, replay_hash):
+        file.write(HEADER.pack(MAGIC, VERSION, LOADER_VERSION, SIM_VERSION,
+                               level_hash, replay_hash, self.steps,
+                               len(self.body_ids)))
+        for id in self.body_ids:
+            id = id.encode('utf-8')
+            file.write(struct.pack('<H', len(id)) + id)
+        file.write(self.poses.tostring())
+
+    @classmethod
+    def read(cls, file, level_hash, replay_hash):
+        """ Returns the track, or None if it is stale or unreadable. """
+        data = file.read(HEADER.size)
+        if len(data) < HEADER.size:
+            return None
+        magic, version, loader_version, sim_version, level, replay, steps, \
+            n = HEADER.unpack(data)
+        if (magic, version, loader_version, sim_version, level, replay) != \
+           (MAGIC, VERSION, LOADER_VERSION, SIM_VERSION, level_hash,
+            replay_hash):
+            return None
+        body_ids = []
+        for i in xrange(n):
+            data = file.read(2)
+            if len(data) < 2:
+                return None
+            length, = struct.unpack('<H', data)
+            data = file.read(length)
+            if len(data) < length:
+                return None
+            try:
+                body_ids.append(data.decode('utf-8'))
+            except UnicodeDecodeError:
+                return None
+        poses = array('f')
+        data = file.read(steps * n * 3 * poses.itemsize)
+        if len(data) != steps * n * 3 * poses.itemsize:
+            return None
+        poses.fromstring(data)
+        return cls(body_ids, poses)
+
+def record_pose_track(sim, replay):
+    """ Runs sim through replay and records the poses of moving bodies. """
+    body_ids = []
+    index = {}
+    frames = []
+    def record_frame():
+        frame = []
+        for body in sim.world:
+            body_data = body.GetUserData()
+            if not body_data or body.IsStatic():
+                continue
+            id = body_data['id']
+            if id not in index:
+                index[id] = len(body_ids)
+                body_ids.append(id)
+            x, y = body.GetPosition().tuple()
+            frame.append((index[id], x, y, body.GetAngle()))
+        frames.append(frame)
+
+    for thrust, turn_direction in replay:
+        sim.ship.thrust = thrust
+        sim.ship.turn_direction = turn_direction
+        sim.step()
+        record_frame()
+
+    n = len(body_ids)
+    poses = array('f', [NAN]) * (len(frames) * n * 3)
+    for step, frame in enumerate(frames):
+        offset = step * n * 3
+        for i, x, y, angle in frame:
+            j = offset + 3 * i
+            poses[j:j + 3] = array('f', (x, y, angle))
+    return PoseTrack(body_ids, poses)
+
+def load_pose_track(level_file_name, replay_file_name, pack=None):
+    """
+    Returns the pose track of a replay on a level, from the cache next to
+    the replay if it is up to date. With a pack, level_file_name is the
+    name of a level in it.
+    """
+    if pack:
+        level = pack.level_hash(level_file_name)
+    else:
+        level = level_hash(level_file_name)
+    with open(replay_file_name, 'rb') as f:
+        replay = hashlib.sha1(f.read()).digest()
+    track_file_name = replay_file_name + TRACK_SUFFIX
+    try:
+        with open(track_file_name, 'rb') as f:
+            track = PoseTrack.read(f, level, replay)
+        if track is not None:
+            return track
+    except IOError:
+        pass
+
+    sim, _, _, _ = make_sim(level_file_name, is_ghost=True, pack=pack)
+    track = record_pose_track(sim, load_replay(replay_file_name))
+    # Write to a temporary file first, so that an interrupted write or a
+    # concurrent reader never sees a half written track.
+    tmp_file_name = '%s.%d.tmp' % (track_file_name, os.getpid())
+    try:
+        with open(tmp_file_name, 'wb') as f:
+            track.write(f, level, replay)
+        os.rename(tmp_file_name, track_file_name)
+    except (IOError, OSError):
+        # Caching is an optimization only.
+        pass
+    return track
+
+def make_template_sim(level_file_name, pack=None):
+    """
+    A sim that is never stepped and has every body of the level created,
+    also those that are created by signals. Ghosts are drawn with its
+    shapes.
+    """
+    sim, _, _, _ = make_sim(level_file_name, is_ghost=True, pack=pack)
+    for listeners in list(sim.signal_listeners):
+        for action, listener in list(listeners):
+            if action == 'created_by':
+                sim.add_object(sim.objects[listener], created=True)
+    return sim
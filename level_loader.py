@@ -1,28 +1,65 @@
 from __future__ import with_statement
 
-from svg_paths import linearize_path, path_area, reverse_path, path_points, triangulate_path, split_paths
+from svg_paths import DEFAULT_FLATNESS, MIN_FLATNESS, linearize_points, points_area, reverse_points, triangulate_points, merge_triangles, MAX_POLYGON_VERTICES
 
-import copy
+import cPickle as pickle
+import hashlib
+import math
+import os
 import re
+from array import array
+from cStringIO import StringIO
 from contextlib import nested
-from xml.dom import minidom, Node
+from itertools import izip
+from xml.parsers import expat
 
 # Utils
 
 class LabelStack(object):
+    """
+    The labels of the enclosing elements, innermost last. Lookups walk
+    the chain outwards, so pushing a label copies nothing. The merged
+    dict is only built for labels that end up in the level, and shared
+    by the elements below that add no keys of their own.
+    """
     def __init__(self):
-        self.stack = [{}]
+        self.labels = [{}]
+        self.merged = [{}]
 
     def push(self, label):
-        self.stack.append(copy.copy(self.stack[-1]))
-        self.stack[-1].update(label)
+        self.labels.append(label)
+        self.merged.append(None)
         return self
 
     def pop(self):
-        self.stack.pop()
+        self.labels.pop()
+        self.merged.pop()
+
+    def __contains__(self, key):
+        for label in reversed(self.labels):
+            if key in label:
+                return True
+        return False
+
+    def get(self, key, default=None):
+        for label in reversed(self.labels):
+            if key in label:
+                return label[key]
+        return default
 
     def __call__(self):
-        return self.stack[-1]
+        """ The merged label of the innermost element. """
+        merged = self.merged
+        i = len(merged) - 1
+        while merged[i] is None:
+            i -= 1
+        label = merged[i]
+        for j in xrange(i + 1, len(merged)):
+            if self.labels[j]:
+                label = dict(label)
+                label.update(self.labels[j])
+            merged[j] = label
+        return label
 
     def __enter__(self):
         return self
@@ -30,28 +67,144 @@ class LabelStack(object):
     def __exit__(self, *exc_info):
         self.pop()
 
+# Matrices are SVG style 6-tuples (a, b, c, d, e, f), standing for the
+# affine 3x3 matrix
+#   a c e
+#   b d f
+#   0 0 1
+IDENTITY = (1.0, 0.0, 0.0, 1.0, 0.0, 0.0)
+
+def multiply(m, n):
+    """ The matrix that applies n first, then m. """
+    a1, b1, c1, d1, e1, f1 = m
+    a2, b2, c2, d2, e2, f2 = n
+    return (a1 * a2 + c1 * b2, b1 * a2 + d1 * b2,
+            a1 * c2 + c1 * d2, b1 * c2 + d1 * d2,
+            a1 * e2 + c1 * f2 + e1, b1 * e2 + d1 * f2 + f1)
+
+def translate_matrix(tx, ty=0.0):
+    return 1.0, 0.0, 0.0, 1.0, tx, ty
+
+def scale_matrix(sx, sy=None):
+    return sx, 0.0, 0.0, sx if sy is None else sy, 0.0, 0.0
+
+def rotate_matrix(angle, cx=0.0, cy=0.0):
+    a = math.radians(angle)
+    cos, sin = math.cos(a), math.sin(a)
+    m = cos, sin, -sin, cos, 0.0, 0.0
+    if cx or cy:
+        m = multiply(multiply(translate_matrix(cx, cy), m),
+                     translate_matrix(-cx, -cy))
+    return m
+
+def skew_x_matrix(angle):
+    return 1.0, 0.0, math.tan(math.radians(angle)), 1.0, 0.0, 0.0
+
+def skew_y_matrix(angle):
+    return 1.0, math.tan(math.radians(angle)), 0.0, 1.0, 0.0, 0.0
+
+def matrix(a, b, c, d, e, f):
+    return a, b, c, d, e, f
+
+# name -> (matrix function, allowed numbers of arguments)
+TRANSFORMS = {
+    'matrix': (matrix, (6,)),
+    'translate': (translate_matrix, (1, 2)),
+    'scale': (scale_matrix, (1, 2)),
+    'rotate': (rotate_matrix, (1, 3)),
+    'skewX': (skew_x_matrix, (1,)),
+    'skewY': (skew_y_matrix, (1,)),
+    }
+
+RE_TRANSFORM = re.compile(r'\s*,?\s*([A-Za-z]+)\s*\(([^)]*)\)')
+RE_NUMBER_SEP = re.compile(r'\s*,\s*|\s+')
+
+def parse_transform(s):
+    """ Composes an SVG transform list into a single matrix. """
+    m = IDENTITY
+    end = 0
+    for match in RE_TRANSFORM.finditer(s):
+        if match.start() != end:
+            break
+        end = match.end()
+        name, args = match.groups()
+        if name not in TRANSFORMS:
+            raise ValueError('Unknown transform %s' % name)
+        function, arg_counts = TRANSFORMS[name]
+        args = [float(arg) for arg in RE_NUMBER_SEP.split(args.strip())
+                if arg]
+        if len(args) not in arg_counts:
+            raise ValueError('Bad arguments for %s: %s' % (name,
+                                                            match.group(2)))
+        m = multiply(m, function(*args))
+    if s[end:].strip():
+        raise ValueError('Bad transform %r' % s)
+    return m
+
+# User units per unit of length, at the 90 dpi of the Inkscape versions the
+# levels are drawn with.
+LENGTH_UNITS = {'': 1.0, 'px': 1.0, 'pt': 1.25, 'pc': 15.0,
+                'mm': 90 / 25.4, 'cm': 90 / 2.54, 'in': 90.0}
+RE_LENGTH = re.compile(r'\s*([-+]?(?:\d+\.?\d*|\.\d+)(?:[eE][-+]?\d+)?)'
+                       r'\s*([a-z]*)\s*$')
+
+def parse_length(s):
+    """ An SVG length, like '297mm', in user units. """
+    match = RE_LENGTH.match(s)
+    if not match or match.group(2) not in LENGTH_UNITS:
+        raise ValueError('Bad length %r' % s)
+    return float(match.group(1)) * LENGTH_UNITS[match.group(2)]
+
 class Transform(object):
+    """
+    The stack of transformation matrices from element coordinates to
+    level coordinates. The matrices are composed on push, so a point is
+    transformed with a single matrix however deep the element is.
+    """
     def __init__(self, height):
         self.height = height
-        self.stack = [(0.0, 0.0)]
+        # Level coordinates have y pointing up.
+        self.stack = [(1.0, 0.0, 0.0, -1.0, 0.0, float(height))]
 
-    def push(self):
-        self.stack.append(self.stack[-1])
+    def push(self, m):
+        self.stack.append(multiply(self.stack[-1], m))
+        return self
 
     def pop(self):
         self.stack.pop()
 
-    def translate(self, t):
-        self.push()
-        x0, y0 = self.stack[-1]
-        x, y = t
-        self.stack[-1] = x0 + x, y0 + y
-        return self
+    def matrix(self):
+        return self.stack[-1]
+
+    def mirrored(self):
+        """
+        True when the element transforms reverse the orientation of
+        shapes, the y flip of the level aside.
+        """
+        a, b, c, d, e, f = self.stack[-1]
+        return a * d - b * c > 0.0
+
+    def max_scale(self):
+        """ How much a length can grow at most: the largest singular value. """
+        a, b, c, d, e, f = self.stack[-1]
+        s = a * a + b * b + c * c + d * d
+        det = a * d - b * c
+        return math.sqrt((s + math.sqrt(max(0.0, s * s - 4 * det * det))) / 2)
 
     def __call__(self, p):
         x, y = p
-        tx, ty = self.stack[-1]
-        return x + tx, self.height - (y + ty)
+        a, b, c, d, e, f = self.stack[-1]
+        return a * x + c * y + e, b * x + d * y + f
+
+    def points(self, points):
+        """ Transforms a flat array of coordinates into (x, y) tuples. """
+        a, b, c, d, e, f = self.stack[-1]
+        xs = points[0::2]
+        ys = points[1::2]
+        if b == 0.0 and c == 0.0:
+            return [(a * x + e, d * y + f) for x, y in izip(xs, ys)]
+        return [(a * x + c * y + e, b * x + d * y + f)
+                for x, y in izip(xs, ys)]
 
     def __enter__(self):
         return self
@@ -66,131 +219,301 @@ def str_to_dict(s, pair_sep=';', key_value_sep=':'):
                 for attr in s.split(pair_sep) if attr != '')
 
 def label_dict(e):
-    label = e.getAttribute('inkscape:label')
+    label = e.get('inkscape:label', '')
     label = str_to_dict(label, ' ', '=')
     return label
 
 def element_common(e):
-    id = e.getAttribute('id')
+    id = e.get('id', '')
     label = label_dict(e)
     return id, label
 
 def shape_common(e):
-    #id = e.getAttribute('id')
-    #label = label_dict(e)
     id, label = element_common(e)
-    sd = str_to_dict(e.getAttribute('style'))
+    sd = str_to_dict(e.get('style', ''))
     return id, label, sd
 
 def get_transform(e):
-    t_attr = e.getAttribute('transform')
-    re_translate = r'translate\((.+),(.+)\)'
-    m = re.match(re_translate, t_attr)
-    if m:
-        return float(m.group(1)), float(m.group(2))
-    else:
-        return 0.0, 0.0
+    return parse_transform(e.get('transform', ''))
         
-def get_winning_condition(node):
-    wc_attr = node.getAttribute('winning_condition')
+def get_winning_condition(e):
+    wc_attr = e.get('winning_condition', '')
     return [signal.strip() for signal in wc_attr.split(',') if signal != '']
   
 # Node handlers
-
-def handle_node_g(node, header, bodies, transform, label):
-    id, l = element_common(node)
-    t = get_transform(node)
-    with nested(label.push(l), transform.translate(t)):
-        if 'multishape' in label():
-            mbodies = []
-            parse_children(node, header, mbodies, transform, label)
-            bodies.append((id, label(),
-                           [shapes[0] for _, _, shapes in mbodies]))
+#
+# A handler is called with the parser state and the attributes of an
+# element when the element starts. It returns what the parser should do
+# when the element ends: None, a function to call, or SKIP_CHILDREN to
+# ignore the whole subtree below the element.
+
+SKIP_CHILDREN = object()
+
+def handle_node_g(state, e):
+    id, l = element_common(e)
+    state.label.push(l)
+    state.transform.push(get_transform(e))
+    if 'multishape' in state.label:
+        outer_bodies = state.bodies
+        state.bodies = []
+    def end():
+        if 'multishape' in state.label:
+            mbodies = state.bodies
+            state.bodies = outer_bodies
+            state.bodies.append((id, state.label(),
+                                 [shapes[0] for _, _, shapes in mbodies]))
+        state.transform.pop()
+        state.label.pop()
+    return end
+
+def handle_node_svg(state, e):
+    # The level is in user units. A viewBox gives the page in them;
+    # otherwise width and height do, if need be converted from mm and the
+    # like.
+    if 'viewBox' in e:
+        x, y, width, height = [float(v) for v in
+                               RE_NUMBER_SEP.split(e['viewBox'].strip())]
+    else:
+        x = y = 0.0
+        width, height = parse_length(e['width']), parse_length(e['height'])
+    state.header.update(width=width, height=height,
+                        winning_condition=get_winning_condition(e))
+    outer_transform = state.transform
+    state.transform = Transform(height)
+    if x or y:
+        state.transform.push(translate_matrix(-x, -y))
+    def end():
+        state.transform = outer_transform
+    return end
+
+def handle_node_namedview(state, e):
+    state.bodies.append(('pagecolor', e.get('pagecolor', '')))
+
+def handle_node_rect(state, e):
+    id, l, sd = shape_common(e)
+    with nested(state.label.push(l),
+                state.transform.push(get_transform(e))) as (label, transform):
+        x, y, w, h = [float(e[n]) for n in ['x', 'y', 'width', 'height']]
+        a, b, c, d, _, _ = transform.matrix()
+        if b == 0.0 and c == 0.0:
+            (x0, y0), (x1, y1) = transform.points(array('d', (x, y + h,
+                                                              x + w, y)))
+            shape = ('rect', id, label(), sd,
+                     ((min(x0, x1), min(y0, y1)), (abs(a) * w, abs(d) * h)))
         else:
-            parse_children(node, header, bodies, transform, label)
-
-def handle_node_svg(node, header, bodies, transform, label):
-    header.update(width=float(node.getAttribute('width')), 
-                  height=float(node.getAttribute('height')),
-                  winning_condition=get_winning_condition(node))
-    transform = Transform(header['height'])
-    parse_children(node, header, bodies, transform, label)
-
-def handle_node_namedview(node, header, bodies, transform, label):
-    bodies.append(('pagecolor', node.getAttribute('pagecolor')))
-    parse_children(node, header, bodies, transform, label)
-
-def handle_node_rect(node, header, bodies, transform, label):
-    id, l, sd = shape_common(node)
-    with label.push(l):
-        x, y, w, h = [float(node.getAttribute(n))
-                      for n in ['x', 'y', 'width', 'height']]
-        bodies.append((id, label(), [('rect', id, label(), sd,
-                                      (transform((x, y + h)), (w, h)))]))
-
-def handle_node_path(node, header, bodies, transform, label):
-    id, l, sd = shape_common(node)
-    t = get_transform(node)
-    with nested(label.push(l), transform.translate(t)):
-        if node.getAttribute('sodipodi:type') == 'arc':
-            x, y, rx, ry = [float(node.getAttribute('sodipodi:'+n))
+            # Rotated or skewed, so no longer a box. Like any closed path,
+            # the outline goes counter clockwise in the level.
+            points = transform.points(array('d', (x, y, x, y + h, x + w,
+                                                  y + h, x + w, y, x, y)))
+            if transform.mirrored():
+                points.reverse()
+            shape = ('polygon', id, label(), sd, points)
+        state.bodies.append((id, label(), [shape]))
+    return SKIP_CHILDREN
+
+def handle_node_path(state, e):
+    id, l, sd = shape_common(e)
+    with nested(state.label.push(l),
+                state.transform.push(get_transform(e))) as (label, transform):
+        if e.get('sodipodi:type', '') == 'arc':
+            x, y, rx, ry = [float(e['sodipodi:'+n])
                             for n in ['cx', 'cy', 'rx', 'ry']]
-            bodies.append((id, label(), [('circle', id, label(), sd,
-                                          (transform((x, y)), (rx, ry)))]))
+            a, b, c, d, _, _ = transform.matrix()
+            radii = rx * math.hypot(a, b), ry * math.hypot(c, d)
+            state.bodies.append((id, label(), [('circle', id, label(), sd,
+                                                (transform((x, y)), radii))]))
         else:
-            path = node.getAttribute('d')
-            path = linearize_path(path)
+            flatness = float(label().get('flatness', DEFAULT_FLATNESS))
+            # flatness=0 would ask for infinitely many segments.
+            flatness = max(flatness, MIN_FLATNESS)
+            # The flatness is in level units, and the path is flattened
+            # before it is transformed.
+            scale = transform.max_scale()
+            if scale > 0.0:
+                flatness /= scale
+            points, is_polygon = linearize_points(e.get('d', ''), flatness,
+                                                  state.header['stats'])
             # Make sure that closed paths are defined counter clockwise
-            if path.split()[-1] == 'z' and path_area(path) > 0.0:
-                path = reverse_path(path)
-            is_polygon = path.split()[-1] == 'z'
+            if is_polygon and points_area(points) > 0.0:
+                points = reverse_points(points)
             name = 'polygon' if is_polygon else 'path'
-            if is_polygon and 'triangulate' in label():
-                convex_path = triangulate_path(path)
-                paths = split_paths(convex_path)
+            if is_polygon and 'decompose' in label():
+                # Like triangulate, but merge the triangles into as few
+                # convex polygons as possible. decompose=N limits the
+                # number of vertices per polygon.
+                max_vertices = label()['decompose']
+                if max_vertices is True:
+                    max_vertices = MAX_POLYGON_VERTICES
+                triangles = triangulate_points(points)
+                pieces = merge_triangles(triangles, int(max_vertices))
+                stats = state.header['stats']
+                stats['shapes_saved'] += len(triangles) - len(pieces)
+            elif is_polygon and 'triangulate' in label():
+                pieces = triangulate_points(points)
             else:
-                paths = [path]
+                pieces = [points]
+            # A mirroring transform would turn the pieces clockwise.
+            mirrored = transform.mirrored()
             parts = []
-            for path in paths:
-                points = path_points(path)
-                points = [transform((x,y)) for x, y in points]
+            for points in pieces:
+                points = transform.points(points)
+                if mirrored:
+                    points.reverse()
                 parts.append((name, id, label(), sd, points))
-            bodies.append((id, label(), parts))
-
-def handle_node_default(node, header, bodies, transform, label):
-    parse_children(node, header, bodies, transform, label)
+            state.bodies.append((id, label(), parts))
+    return SKIP_CHILDREN
+
+def handle_node_skip(state, e):
+    return SKIP_CHILDREN
+
+NODE_HANDLERS = {
+    'g': handle_node_g, 
+    'svg': handle_node_svg, 
+    'path': handle_node_path, 
+    'rect': handle_node_rect, 
+    'sodipodi:namedview': handle_node_namedview,
+    # Never part of the level geometry.
+    'metadata': handle_node_skip,
+    'defs': handle_node_skip,
+    }
 
 # Level parser
 
-def parse_children(node, header, bodies, transform, label):
-    for child in node.childNodes:
-        parse_subtree(child, header, bodies, transform, label)
-
-def parse_subtree(node, header, bodies, transform, label):
-    handlers = {
-            'g': handle_node_g, 
-            'svg': handle_node_svg, 
-            'path': handle_node_path, 
-            'rect': handle_node_rect, 
-            'sodipodi:namedview': handle_node_namedview
-            }
-    handlers.get(node.nodeName, handle_node_default)(node, header,
-                                                     bodies, transform, label)
+class LevelParser(object):
+    """
+    Builds the level in a single streaming pass over the SVG. No document
+    tree is built; elements are handled as expat reports them.
+    """
+    def __init__(self):
+        # header['stats']: Box2D shapes saved by 'decompose', and the
+        # curves flattened and the segments they became.
+        self.header = dict(stats=dict(shapes_saved=0, curves=0,
+                                      curve_segments=0))
+        self.bodies = []
+        self.label = LabelStack()
+        self.transform = None
+        self.end_actions = []
+        self.skip_depth = 0
+
+    def start_element(self, name, attributes):
+        if self.skip_depth:
+            self.skip_depth += 1
+            return
+        handler = NODE_HANDLERS.get(name, None)
+        action = handler(self, attributes) if handler else None
+        if action is SKIP_CHILDREN:
+            self.skip_depth = 1
+        else:
+            self.end_actions.append(action)
+
+    def end_element(self, name):
+        if self.skip_depth:
+            self.skip_depth -= 1
+            return
+        action = self.end_actions.pop()
+        if action:
+            action()
+
+    def parse(self, file):
+        parser = expat.ParserCreate()
+        parser.StartElementHandler = self.start_element
+        parser.EndElementHandler = self.end_element
+        parser.ParseFile(file)
+        return self.header, self.bodies
 
 def read_level(file):
-    root = minidom.parse(file)
-    header = {}
-    bodies = []
-    label = LabelStack()
-
-    parse_subtree(root, header, bodies, None, label)
-    
-    return header, bodies
+    return LevelParser().parse(file)
+
+# Level cache
+
+# Bump this whenever the output of read_level() changes, so that stale
+# cache entries are never picked up.
+LOADER_VERSION = 9
+CACHE_MAGIC = 'FPGL'
+CACHE_DIR = '.level_cache'
+
+def level_cache_path(file_name, content):
+    """
+    The cache entry for a level is keyed by the loader version and a hash
+    of the SVG content. It lives in a directory next to the level file.
+    """
+    key = hashlib.sha1('%s %d\n' % (CACHE_MAGIC, LOADER_VERSION))
+    key.update(content)
+    level_dir = os.path.dirname(os.path.abspath(file_name))
+    return os.path.join(level_dir, CACHE_DIR, key.hexdigest() + '.lvl')
+
+def load_cached_level(path):
+    """ Returns the cached (header, bodies) or None on a cache miss. """
+    try:
+        with open(path, 'rb') as f:
+            if f.read(len(CACHE_MAGIC)) != CACHE_MAGIC:
+                return None
+            return pickle.load(f)
+    except (IOError, EOFError, ValueError, pickle.UnpicklingError):
+        return None
+
+def store_cached_level(path, level):
+    # Write to a temporary file first, so that a concurrent reader never
+    # sees a half written cache entry.
+    tmp_path = '%s.%d.tmp' % (path, os.getpid())
+    try:
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        with open(tmp_path, 'wb') as f:
+            f.write(CACHE_MAGIC)
+            pickle.dump(level, f, pickle.HIGHEST_PROTOCOL)
+        os.rename(tmp_path, path)
+    except (IOError, OSError):
+        # Caching is an optimization only. A read only level directory
+        # should not stop the game.
+        pass
+
+def read_level_cached(file_name):
+    """
+    Like read_level(), but takes a file name and reuses the parsed level
+    from the on-disk cache when the SVG content has not changed.
+    """
+    with open(file_name, 'rb') as f:
+        content = f.read()
+    path = level_cache_path(file_name, content)
+    level = load_cached_level(path)
+    if level is None:
+        level = read_level(StringIO(content))
+        store_cached_level(path, level)
+    return level
+
+def time_level_load(file_name, repeat=10):
+    """ Returns the best cold (parse) and warm (cache) load times in s. """
+    import timeit
+    with open(file_name, 'rb') as f:
+        content = f.read()
+    path = level_cache_path(file_name, content)
+    store_cached_level(path, read_level(StringIO(content)))
+    cold = min(timeit.repeat(lambda: read_level(StringIO(content)),
+                             number=1, repeat=repeat))
+    warm = min(timeit.repeat(lambda: load_cached_level(path),
+                             number=1, repeat=repeat))
+    return cold, warm
 
 
 def main(argv):
+    from optparse import OptionParser
+    parser = OptionParser(usage='%prog [options] LEVEL')
+    parser.add_option('-t', '--time', dest='time', action='store_true',
+                      help='Report cold and warm (cached) load times.')
+    options, args = parser.parse_args(argv[1:])
+    if len(args) < 1:
+        parser.error('Level file name must be given. ')
+
+    if options.time:
+        cold, warm = time_level_load(args[0])
+        print 'cold: %.2f ms, warm: %.2f ms (%.1fx)' % (cold * 1000,
+                                                      warm * 1000,
+                                                      cold / warm)
+        return
+
     import pprint
-    with open(argv[1]) as f:
+    with open(args[0]) as f:
         header, bodies = read_level(f)
     pprint.pprint(header)
     pprint.pprint(list(bodies))
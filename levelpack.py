@@ -0,0 +1,238 @@
+from __future__ import with_statement
+
+from level_loader import LOADER_VERSION, read_level
+
+import cPickle as pickle
+import hashlib
+import mmap
+import multiprocessing
+import os
+import struct
+import sys
+from array import array
+from cStringIO import StringIO
+from optparse import OptionParser
+
+# A pack holds many parsed levels in one file. Every level is stored as a
+# pickled outline, with the shape geometry replaced by offsets into a flat
+# array of little endian doubles. The file is memory mapped, so opening a
+# level reads only its own outline and vertices.
+#
+# File layout:
+#   magic 'FPGK', version (u8), loader version (u32), table of contents
+#   offset (u64) and length (u32), then the levels. The table of contents
+#   is a pickled dict of name -> (outline offset, outline length, vertex
+#   offset, vertex count, sha1 of the level SVG). Vertex arrays start at
+#   multiples of 8 bytes.
+MAGIC = 'FPGK'
+VERSION = 1
+HEADER = struct.Struct('<4sBIQI')
+
+class PackFormatError(Exception):
+    pass
+
+def level_name(file_name):
+    return os.path.splitext(os.path.basename(file_name))[0]
+
+# Flattening
+
+def flatten_level(level):
+    """
+    Splits a parsed level into an outline without coordinates, and an
+    array of all its coordinates.
+    """
+    header, bodies = level
+    vertices = array('d')
+    def flat_shape(shape):
+        type, id, label, style, geometry = shape
+        start = len(vertices)
+        if type in ('rect', 'circle'):
+            # ((x, y), (width, height)) and ((x, y), (rx, ry))
+            (a, b), (c, d) = geometry
+            vertices.extend((a, b, c, d))
+        else:
+            for p in geometry:
+                vertices.extend(p)
+        return type, id, label, style, (start, len(vertices))
+    outline = []
+    for body in bodies:
+        if len(body) < 3 or body[2] is None:
+            outline.append(body)
+        else:
+            id, label, shapes = body
+            outline.append((id, label, [flat_shape(s) for s in shapes]))
+    return (header, outline), vertices
+
+def unflatten_level(outline, vertices):
+    header, bodies = outline
+    def shape(flat_shape):
+        type, id, label, style, (start, end) = flat_shape
+        if type in ('rect', 'circle'):
+            a, b, c, d = vertices[start:end]
+            geometry = (a, b), (c, d)
+        else:
+            geometry = [(vertices[i], vertices[i + 1])
+                        for i in xrange(start, end, 2)]
+        return type, id, label, style, geometry
+    level = []
+    for body in bodies:
+        if len(body) < 3 or body[2] is None:
+            level.append(body)
+        else:
+            id, label, shapes = body
+            level.append((id, label, [shape(s) for s in shapes]))
+    return header, level
+
+# Compiling
+
+def compile_level(file_name):
+    """ Parses one level. Runs in a worker process. """
+    try:
+        with open(file_name, 'rb') as f:
+            content = f.read()
+        level = read_level(StringIO(content))
+        outline, vertices = flatten_level(level)
+        if sys.byteorder != 'little':
+            vertices.byteswap()
+        return (file_name, hashlib.sha1(content).digest(),
+                pickle.dumps(outline, pickle.HIGHEST_PROTOCOL),
+                vertices.tostring(), None)
+    except Exception, e:
+        return file_name, None, None, None, '%s: %s' % (type(e).__name__, e)
+
+def compile_pack(file_names, pack_file_name, processes=None):
+    """
+    Parses the levels in a process pool and writes them to a pack.
+    Returns a list of (file name, error) for the levels that failed.
+    """
+    pool = multiprocessing.Pool(processes)
+    try:
+        compiled = pool.map(compile_level, file_names)
+    finally:
+        pool.terminate()
+        pool.join()
+
+    toc = {}
+    errors = []
+    tmp_name = '%s.%d.tmp' % (pack_file_name, os.getpid())
+    with open(tmp_name, 'wb') as f:
+        f.write('\0' * HEADER.size)
+        for file_name, digest, outline, vertices, error in compiled:
+            if error:
+                errors.append((file_name, error))
+                continue
+            name = level_name(file_name)
+            if name in toc:
+                errors.append((file_name, 'Duplicate level name %s' % name))
+                continue
+            outline_offset = f.tell()
+            f.write(outline)
+            f.write('\0' * (-f.tell() % 8))
+            vertex_offset = f.tell()
+            f.write(vertices)
+            toc[name] = (outline_offset, len(outline), vertex_offset,
+                         len(vertices) // 8, digest)
+        toc_offset = f.tell()
+        toc_data = pickle.dumps(toc, pickle.HIGHEST_PROTOCOL)
+        f.write(toc_data)
+        f.seek(0)
+        f.write(HEADER.pack(MAGIC, VERSION, LOADER_VERSION, toc_offset,
+                            len(toc_data)))
+    os.rename(tmp_name, pack_file_name)
+    return errors
+
+# Reading
+
+class LevelPack(object):
+    def __init__(self, file_name):
+        self.file_name = file_name
+        self.file = open(file_name, 'rb')
+        try:
+            self.map = mmap.mmap(self.file.fileno(), 0,
+                                 access=mmap.ACCESS_READ)
+            if len(self.map) < HEADER.size:
+                raise PackFormatError('Truncated pack header')
+            magic, version, loader_version, toc_offset, toc_length = \
+                HEADER.unpack(self.map[:HEADER.size])
+            if magic != MAGIC:
+                raise PackFormatError('Not a level pack')
+            if version != VERSION or loader_version != LOADER_VERSION:
+                raise PackFormatError('Level pack is from another version; '
+                                      'compile it again')
+            self.toc = pickle.loads(self.map[toc_offset:
+                                             toc_offset + toc_length])
+        except:
+            self.close()
+            raise
+
+    def names(self):
+        return sorted(self.toc)
+
+    def __contains__(self, name):
+        return name in self.toc
+
+    def level_hash(self, name):
+        """ The sha1 of the SVG the level was compiled from. """
+        return self.toc[name][4]
+
+    def read_level(self, name):
+        """ Returns (header, bodies) like level_loader.read_level(). """
+        if name not in self.toc:
+            raise KeyError('No level %s in %s' % (name, self.file_name))
+        outline_offset, outline_length, vertex_offset, n, digest = \
+            self.toc[name]
+        outline = pickle.loads(self.map[outline_offset:
+                                        outline_offset + outline_length])
+        vertices = array('d')
+        vertices.fromstring(self.map[vertex_offset:vertex_offset + 8 * n])
+        if sys.byteorder != 'little':
+            vertices.byteswap()
+        return unflatten_level(outline, vertices)
+
+    def close(self):
+        if getattr(self, 'map', None):
+            self.map.close()
+            self.map = None
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+def level_files(paths):
+    """ The SVG files among paths, and in the directories among them. """
+    for path in paths:
+        if os.path.isdir(path):
+            for name in sorted(os.listdir(path)):
+                if name.endswith('.svg'):
+                    yield os.path.join(path, name)
+        else:
+            yield path
+
+
+def main():
+    parser = OptionParser(usage='%prog [options] PACK [LEVEL_OR_DIR...]\n\n'
+                          'Compiles the level SVGs, and those in the given '
+                          'directories, into PACK. Lists PACK when no '
+                          'levels are given.')
+    parser.add_option('-j', '--jobs', dest='jobs', type='int', default=None,
+                      help='Number of worker processes. Default is one per '
+                           'core.')
+    options, args = parser.parse_args()
+    if len(args) < 1:
+        parser.error('Pack file name must be given. ')
+
+    if len(args) == 1:
+        with LevelPack(args[0]) as pack:
+            for name in pack.names():
+                print '%-30s %s' % (name, pack.level_hash(name).encode('hex'))
+        return
+
+    errors = compile_pack(list(level_files(args[1:])), args[0], options.jobs)
+    for file_name, error in errors:
+        print >> sys.stderr, 'Skipped %s: %s' % (file_name, error)
+
+if __name__ == '__main__':
+    main()
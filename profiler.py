@@ -0,0 +1,91 @@
+from __future__ import with_statement
+
+from array import array
+from timeit import default_timer
+
+# The clock with the best resolution on this platform.
+timer = default_timer
+
+# Every phase keeps the durations of its last SAMPLES runs, about ten
+# seconds of frames, and the percentiles are taken over those.
+SAMPLES = 600
+PERCENTILES = (50, 95, 99)
+
+class PhaseStats(object):
+    def __init__(self, samples=SAMPLES):
+        self.samples = array('d', [0.0]) * samples
+        self.filled = 0
+        self.next = 0
+        # Over all runs, not only the rolling window.
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def add(self, seconds):
+        self.samples[self.next] = seconds
+        self.next = (self.next + 1) % len(self.samples)
+        self.filled = min(self.filled + 1, len(self.samples))
+        self.count += 1
+        self.total += seconds
+        if seconds > self.max:
+            self.max = seconds
+
+    def percentiles(self, ps=PERCENTILES):
+        """ Nearest rank percentiles of the rolling window. """
+        if not self.filled:
+            return [0.0 for p in ps]
+        recent = sorted(self.samples[:self.filled])
+        return [recent[max(0, (p * self.filled + 99) // 100 - 1)] for p in ps]
+
+    @property
+    def mean(self):
+        return self.total / self.count if self.count else 0.0
+
+class Profiler(object):
+    """
+    Collects the durations of named phases, and named counters such as
+    the vertices drawn in a frame. Code that can be profiled keeps a
+    profiler attribute that is None while profiling is off, and only calls
+    the timer when it is set.
+    """
+    def __init__(self, samples=SAMPLES):
+        self.sample_count = samples
+        self.phases = {}
+        self.counters = {}
+
+    def add(self, phase, seconds):
+        stats = self.phases.get(phase)
+        if stats is None:
+            stats = self.phases[phase] = PhaseStats(self.sample_count)
+        stats.add(seconds)
+
+    def add_counter(self, counter, value):
+        stats = self.counters.get(counter)
+        if stats is None:
+            stats = self.counters[counter] = PhaseStats(self.sample_count)
+        stats.add(value)
+
+    def report_lines(self):
+        yield '%-16s %8s %8s %8s %8s %8s %8s' % (
+            'phase (ms)', 'count', 'mean', 'p50', 'p95', 'p99', 'max')
+        for phase in sorted(self.phases):
+            stats = self.phases[phase]
+            p50, p95, p99 = stats.percentiles()
+            yield '%-16s %8d %8.3f %8.3f %8.3f %8.3f %8.3f' % (
+                phase, stats.count, stats.mean * 1000, p50 * 1000,
+                p95 * 1000, p99 * 1000, stats.max * 1000)
+        if self.counters:
+            yield '%-16s %8s %8s %8s %8s %8s %8s' % (
+                'counter', 'count', 'mean', 'p50', 'p95', 'p99', 'max')
+        for counter in sorted(self.counters):
+            stats = self.counters[counter]
+            p50, p95, p99 = stats.percentiles()
+            yield '%-16s %8d %8.1f %8d %8d %8d %8d' % (
+                counter, stats.count, stats.mean, p50, p95, p99, stats.max)
+
+    def report(self):
+        return '\n'.join(self.report_lines())
+
+    def dump(self, file_name):
+        with open(file_name, 'w') as f:
+            f.write(self.report() + '\n')
@@ -0,0 +1,189 @@
+from __future__ import with_statement
+
+from level_loader import LOADER_VERSION
+
+import hashlib
+import pickle
+import struct
+from array import array
+
+# The ship has six control states. A replay stores the index of the state
+# for every step, run-length encoded.
+CONTROL_STATES = [(thrust, turn_direction)
+                  for thrust in (False, True)
+                  for turn_direction in (-1, 0, 1)]
+STATE_INDEX = dict((state, i) for i, state in enumerate(CONTROL_STATES))
+STATE_BITS = 3
+
+# File layout, all little endian:
+#   magic 'FPGR', version (u8), LOADER_VERSION and SIM_VERSION of the
+#   build that recorded it (u16 each), sha1 of the level SVG (20 bytes),
+#   steps (u32), runs (u32), then every run as a varint of
+#   (length << STATE_BITS) | state.
+MAGIC = 'FPGR'
+VERSION = 2
+HEADER = struct.Struct('<4sBHH20sII')
+
+class ReplayFormatError(Exception):
+    pass
+
+def build_versions():
+    """ The (loader, sim) versions of this build. """
+    # sim needs Box2D, so it is only imported once a replay is written or
+    # checked, which needs a sim anyway.
+    from sim import SIM_VERSION
+    return LOADER_VERSION, SIM_VERSION
+
+def check_versions(replay):
+    """
+    Raises ReplayFormatError unless replay was recorded with the level
+    loader and sim of this build. Other builds may play it differently.
+    """
+    versions = build_versions()
+    if replay.versions is not None and replay.versions != versions:
+        raise ReplayFormatError('Replay was recorded with loader version %d '
+                                'and sim version %d, this build has %d and '
+                                '%d' % (replay.versions + versions))
+
+def level_hash(file_name):
+    with open(file_name, 'rb') as f:
+        return hashlib.sha1(f.read()).digest()
+
+class Replay(object):
+    """
+    The controls of a run, stored as runs of identical control states.
+    versions are the (loader, sim) versions it was recorded with, or None
+    for this build.
+    """
+    def __init__(self, level_hash='\0' * 20, versions=None):
+        self.level_hash = level_hash
+        self.versions = versions
+        self.states = array('B')
+        self.lengths = array('I')
+        self.steps = 0
+
+    def append(self, thrust, turn_direction):
+        state = STATE_INDEX[bool(thrust), int(turn_direction)]
+        if self.states and self.states[-1] == state:
+            self.lengths[-1] += 1
+        else:
+            self.states.append(state)
+            self.lengths.append(1)
+        self.steps += 1
+
+    def clear(self):
+        del self.states[:]
+        del self.lengths[:]
+        self.steps = 0
+
+    def extend(self, controls):
+        for thrust, turn_direction in controls:
+            self.append(thrust, turn_direction)
+
+    def __iter__(self):
+        for state, length in zip(self.states, self.lengths):
+            control = CONTROL_STATES[state]
+            for i in xrange(length):
+                yield control
+
+    def __len__(self):
+        return self.steps
+
+    def write(self, file):
+        runs = array('B')
+        for state, length in zip(self.states, self.lengths):
+            v = (length << STATE_BITS) | state
+            while v >= 0x80:
+                runs.append((v & 0x7f) | 0x80)
+                v >>= 7
+            runs.append(v)
+        loader_version, sim_version = self.versions or build_versions()
+        file.write(HEADER.pack(MAGIC, VERSION, loader_version, sim_version,
+                               self.level_hash, self.steps,
+                               len(self.states)))
+        file.write(runs.tostring())
+
+    @classmethod
+    def read(cls, file):
+        # Magic and version first, as older versions have shorter headers.
+        data = file.read(len(MAGIC) + 1)
+        if len(data) < len(MAGIC) + 1:
+            raise ReplayFormatError('Truncated replay header')
+        magic, version = struct.unpack('<4sB', data)
+        if magic != MAGIC:
+            raise ReplayFormatError('Not a replay file')
+        if version != VERSION:
+            raise ReplayFormatError('Unsupported replay version %d, record '
+                                    'it again' % version)
+        data += file.read(HEADER.size - len(data))
+        if len(data) < HEADER.size:
+            raise ReplayFormatError('Truncated replay header')
+        _, _, loader_version, sim_version, level_hash, steps, n_runs = \
+            HEADER.unpack(data)
+        replay = cls(level_hash, (loader_version, sim_version))
+        runs = array('B', file.read())
+        v = shift = 0
+        for byte in runs:
+            v |= (byte & 0x7f) << shift
+            shift += 7
+            if not byte & 0x80:
+                replay.states.append(v & ((1 << STATE_BITS) - 1))
+                replay.lengths.append(v >> STATE_BITS)
+                v = shift = 0
+        replay.steps = sum(replay.lengths)
+        if len(replay.states) != n_runs or replay.steps != steps:
+            raise ReplayFormatError('Corrupt replay')
+        return replay
+
+def read_pickle_log(file, level_hash='\0' * 20):
+    """
+    Reads a log of pickled (thrust, turn_direction) tuples. Their versions
+    are unknown, (0, 0).
+    """
+    replay = Replay(level_hash, (0, 0))
+    try:
+        while True:
+            replay.append(*pickle.load(file))
+    except EOFError:
+        pass
+    return replay
+
+def load_replay(file_name):
+    """ Loads a replay, in either the binary or the old pickle format. """
+    with open(file_name, 'rb') as f:
+        is_binary = f.read(len(MAGIC)) == MAGIC
+        f.seek(0)
+        if is_binary:
+            return Replay.read(f)
+        else:
+            return read_pickle_log(f)
+
+def save_replay(file_name, replay):
+    with open(file_name, 'wb') as f:
+        replay.write(f)
+
+
+def main():
+    from optparse import OptionParser
+    parser = OptionParser(usage='%prog [options] REPLAY [OUTPUT]\n\n'
+                          'Prints information about REPLAY, or converts it '
+                          'to the binary format if OUTPUT is given.')
+    parser.add_option('-l', '--level', dest='level_file', metavar='FILE',
+                      help='Record the hash of level FILE when converting.')
+    options, args = parser.parse_args()
+    if len(args) < 1:
+        parser.error('Replay file name must be given. ')
+
+    replay = load_replay(args[0])
+    if options.level_file:
+        replay.level_hash = level_hash(options.level_file)
+    if len(args) > 1:
+        save_replay(args[1], replay)
+    print 'level: %s' % replay.level_hash.encode('hex')
+    if replay.versions:
+        print 'loader version: %d, sim version: %d' % replay.versions
+    print 'steps: %d' % replay.steps
+    print 'runs:  %d' % len(replay.states)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,593 @@
+from __future__ import with_statement
+
+from level_loader import read_level_cached
+from profiler import timer
+
+from array import array
+from collections import defaultdict
+
+from Box2D import *
+
+# Bump this whenever a change to the sim changes how a replay plays out,
+# so that results computed with an older sim are not reused.
+SIM_VERSION = 2
+
+def parse_hex_color(s):
+    if s == 'none':
+        return None
+    s = s[1:]
+    return tuple(int(s[i:i+2], 16)/255.0 for i in xrange(0, 6, 2))
+
+class ContactListener(b2ContactListener):
+    def __init__(self, signal_callback):
+        super(ContactListener, self).__init__()
+        self.signal = signal_callback
+        self.ship = None
+
+    def Add(self, point):
+        b1 = point.shape1.GetBody()
+        b2 = point.shape2.GetBody()
+        data1 = b1.GetUserData()
+        data2 = b2.GetUserData()
+
+        # Signals, as ids in the signal table of the sim.
+        if b1 == self.ship:
+            for signal_id in data2['ship_triggers']:
+                self.signal(signal_id)
+        elif b2 == self.ship:
+            for signal_id in data1['ship_triggers']:
+                self.signal(signal_id)
+
+        for signal_id in data1['triggers']:
+            self.signal(signal_id)
+        for signal_id in data2['triggers']:
+            self.signal(signal_id)
+
+    def Persist(self, point):
+        pass
+
+    def Remove(self, point):
+        pass
+
+    def Result(self, point):
+        pass
+
+class Ship(object):
+    def __init__(self, body):
+        self.body = body
+        self.turn_speed = 2
+        self.acceleration_force = (0, 1500)
+        self.thrust = False
+        self.turn_direction = 0
+
+    @property
+    def position(self):
+        return self.body.GetWorldCenter().tuple()
+    
+    @property
+    def velocity(self):
+        return self.body.GetLinearVelocity().tuple()
+
+    def apply_controls(self):
+        self.apply_thrust()
+        self.apply_turn()
+
+    def apply_thrust(self):
+        if self.thrust:
+            f = self.body.GetWorldVector(self.acceleration_force)
+            p = self.body.GetWorldCenter()
+            self.body.ApplyForce(f, p)
+
+    def apply_turn(self):
+        self.body.SetAngularVelocity(self.turn_speed * self.turn_direction)
+
+class Sim(object):
+    GAME_OVER = object()
+    LEVEL_COMPLETED = object()
+
+    def __init__(self, width, height, winning_condition, is_ghost=False,
+                 signal_listener=None, game_end_listener=None,
+                 shape_caches=None):
+        self.winning_condition = winning_condition
+        self.is_ghost = is_ghost
+        self.external_signal_listener = signal_listener
+        self.game_end_listener = game_end_listener
+        self.time_step = 1.0 / 60.0
+        self.steps_taken = 0
+        self.thrust = False
+        self.turn_direction = 0
+        self.width = width
+        self.height = height
+        self.gravity = (0, -5)
+        self.bodies = {}
+        # Incremented whenever a body is created or destroyed.
+        self.body_generation = 0
+        # Every object of the level by id, also those that signals create
+        # later. Sims built from the same LevelTemplate share it, and
+        # snapshots refer to objects by id only.
+        self.objects = {}
+        # The ids of the forces and joints that have been added, in order.
+        self.force_ids = []
+        self.joint_ids = []
+        # (body id, shape index) -> dict kept in the user data of the Box2D
+        # shape, where the renderer caches tessellations. Sims built from
+        # the same LevelTemplate share them.
+        self.shape_caches = {} if shape_caches is None else shape_caches
+        # (body id, shape index) -> Box2D shape definition, or None for
+        # shapes that are not created.
+        self.shape_defs = {}
+        # Forces by the id of the body they apply to. Those of the bodies
+        # that exist are bound in bound_forces as id -> (body, forces);
+        # they are bound when the body is created and dropped when it is
+        # destroyed.
+        self.forces_by_body = defaultdict(list)
+        self.bound_forces = {}
+        self.accumulated_signals = set()
+        # The signal table. Bodies trigger signals by number, and the
+        # listeners of signal i are in signal_listeners[i]. Every signal
+        # of the level is numbered when it is loaded, in level order, so
+        # that all sims of a level share the numbers.
+        self.signal_ids = {}
+        self.signal_names = []
+        self.signal_listeners = []
+        self.emitted_signals = set()
+        self.game_end_status = None
+        # A profiler.Profiler while the phases of step() are timed.
+        self.profiler = None
+
+        self.contact_listener = ContactListener(self.signal)
+        self.world = self.create_world()
+
+    def create_world(self):
+        worldAABB = b2AABB()
+        worldAABB.lowerBound.Set(0, 0)
+        worldAABB.upperBound.Set(self.width, self.height)
+        gravity = b2Vec2(*self.gravity)
+        doSleep = True
+        world = b2World(worldAABB, gravity, doSleep)
+        world.SetContactListener(self.contact_listener)
+        return world
+
+    def set_gravity(self, gravity):
+        self.gravity = gravity
+        self.world.SetGravity(b2Vec2(*gravity))
+
+    def set_ship_body(self, body):
+        self.ship = Ship(body)
+        self.ship_id = body.GetUserData()['id']
+        self.contact_listener.ship = body
+
+    def add_shape(self, body, shape_data, cache_key):
+        # restore() creates the same shapes over and over, so their
+        # definitions are kept. Box2D copies a definition on creation.
+        if cache_key in self.shape_defs:
+            shape_def = self.shape_defs[cache_key]
+        else:
+            shape_def = self.make_shape_def(shape_data, cache_key)
+            self.shape_defs[cache_key] = shape_def
+        if shape_def is None:
+            return None
+        return body.CreateShape(shape_def)
+
+    def make_shape_def(self, shape_data, cache_key):
+        type, shape_id, label, style, geometry = shape_data
+        if type == 'rect':
+            (left, lower), (width, height) = geometry
+            shape_def = b2PolygonDef()
+            position = (left + width / 2, lower + height / 2)
+            shape_def.SetAsBox(width / 2, height / 2, position, 0)
+        elif type == 'polygon':
+            vertices = geometry[:-1] # Remove final point
+            shape_def = b2PolygonDef()
+            shape_def.setVertices(vertices)
+        elif type == 'circle':
+            position, (rx, ry) = geometry
+            if rx != ry:
+                raise Exception('Cannot handle ovals')
+            shape_def = b2CircleDef()
+            shape_def.radius = rx
+            shape_def.localPosition = position
+        elif type == 'path':
+            vertices = geometry
+            shape_def = b2EdgeChainDef()
+            if 'flip' in label:
+                shape_def.setVertices(list(reversed(vertices)))
+            else:
+                shape_def.setVertices(vertices)                
+            shape_def.isALoop = False
+        else:
+            return None
+
+        # Paths are drawn in their stroke colour.
+        color = parse_hex_color(style['stroke'] if type == 'path'
+                                else style['fill'])
+        if not color:
+            return None
+
+        shape_def.density = float(label.get('density', shape_def.density))
+        shape_def.friction = float(label.get('friction', shape_def.friction))
+        shape_def.restitution = float(label.get('restitution',
+                                                shape_def.restitution))
+        if 'sensor' in label:
+            shape_def.isSensor = True
+        cache = self.shape_caches.setdefault(cache_key, {})
+        shape_def.SetUserData(dict(color=color,
+                                   invisible=('invisible' in label),
+                                   tessellations=cache))
+        return shape_def
+
+    def signal_id(self, name):
+        """ The number of signal name, added to the table if it is new. """
+        signal_id = self.signal_ids.get(name)
+        if signal_id is None:
+            signal_id = self.signal_ids[name] = len(self.signal_names)
+            self.signal_names.append(name)
+            self.signal_listeners.append([])
+        return signal_id
+
+    def label_signals(self, label, category):
+        """ The numbers of the signals a label lists in category. """
+        signals = label.get(category, '')
+        return tuple(self.signal_id(s.strip())
+                     for s in signals.split(',') if s != '')
+
+    def register_signals(self, label):
+        self.label_signals(label, 'triggers')
+        self.label_signals(label, 'ship_triggers')
+        for slot in ('created_by', 'destroyed_by'):
+            if slot in label:
+                self.signal_id(label[slot])
+
+    def signal(self, signal_id):
+        self.emitted_signals.add(signal_id)
+
+    def set_up_listeners(self, listener, label, slot):
+        if slot in label:
+            signal_id = self.signal_id(label[slot])
+            self.signal_listeners[signal_id].append((slot, listener))
+
+    def handle_emitted_signals(self):
+        # A signal emitted several times in a step is handled once.
+        for signal_id in sorted(self.emitted_signals):
+            name = self.signal_names[signal_id]
+            self.accumulated_signals.add(name)
+            listeners = self.signal_listeners[signal_id]
+            if listeners:
+                # Every listener fires once. Listeners set up by the
+                # bodies created here go to the new list, and wait for
+                # the next time the signal is emitted.
+                self.signal_listeners[signal_id] = []
+                for action, listener in listeners:
+                    if action == 'destroyed_by':
+                        self.destroy_body(listener)
+                    elif action == 'created_by':
+                        self.add_object(self.objects[listener],
+                                        created=True)
+            if self.external_signal_listener:
+                self.external_signal_listener(name)
+
+    def check_game_end_condition(self):
+        if 'game_over' in self.accumulated_signals:
+            self.end_game(self.GAME_OVER)
+        elif self.winning_condition.issubset(self.accumulated_signals):
+            self.end_game(self.LEVEL_COMPLETED)
+
+    def end_game(self, status):
+        self.game_end_status = status
+        if self.game_end_listener:
+            self.game_end_listener(status)
+
+    def find_body(self, id):
+        return self.bodies.get(id, None)
+
+    def destroy_body(self, id):
+        body = self.bodies.pop(id, None)
+        if body:
+            self.bound_forces.pop(id, None)
+            self.world.DestroyBody(body)
+            self.body_generation += 1
+
+    def apply_forces(self):
+        for body, forces in self.bound_forces.itervalues():
+            p = body.GetWorldCenter()
+            for force in forces:
+                body.ApplyForce(force, p)
+
+    def bind_forces(self, id):
+        forces = self.forces_by_body.get(id)
+        if forces:
+            self.bound_forces[id] = (self.bodies[id], forces)
+
+    def add_force(self, force_data):
+        id, label, force = force_data
+        (p1x, p1y), (p2x, p2y) = force[0][4]
+        x, y = p2x-p1x, p2y-p1y
+        k = float(label.get('multiplier', 1.0))
+        apply_to = label['applies_force']
+        self.forces_by_body[apply_to].append(b2Vec2(k*x, k*y))
+        self.force_ids.append(id)
+        if apply_to in self.bodies:
+            self.bind_forces(apply_to)
+
+    def add_joint(self, joint_data):
+        self.joint_ids.append(joint_data[0])
+        self.create_joint(joint_data)
+
+    def create_joint(self, joint_data):
+        id, label, joint = joint_data
+        body1_id = label['body1']
+        body2_id = label['body2']
+        position = joint[0][4][0] # Position, for instance center of circle
+        joint_def = b2RevoluteJointDef()
+        joint_def.Initialize(self.bodies[body1_id], self.bodies[body2_id],
+                             position)
+        self.world.CreateJoint(joint_def)
+        
+    def add_object(self, body_data, created=False):
+        id, label, shape_data = body_data
+
+        if 'created_by' in label and not created:
+            # This body should not created now. It will be created when
+            # its creation signal is emitted.
+            # Its destroyed_by listener is not set up until then, because
+            # it cannot be destroyed before it has been created.
+            self.set_up_listeners(id, label, 'created_by')
+            return None
+
+        if 'applies_force' in label:
+            self.add_force(body_data)
+            return None
+
+        if 'revolute_joint' in label:
+            self.add_joint(body_data)
+            return None
+
+        body = self.create_body(body_data)
+        self.set_up_listeners(id, label, 'destroyed_by')
+        return body
+
+    def create_body(self, body_data):
+        id, label, shape_data = body_data
+        bodyDef = b2BodyDef()
+        body = self.world.CreateBody(bodyDef)
+
+        body_shapes = [self.add_shape(body, shape, (id, i))
+                       for i, shape in enumerate(shape_data)]
+
+        body.SetMassFromShapes()
+
+        triggers = self.label_signals(label, 'triggers')
+        ship_triggers = self.label_signals(label, 'ship_triggers')
+        body.SetUserData(defaultdict(lambda: None, id=id,
+                                     shapes=body_shapes,
+                                     triggers=triggers,
+                                     ship_triggers=ship_triggers))
+
+        self.bodies[id] = body
+        self.bind_forces(id)
+        self.body_generation += 1
+        return body
+
+    def snapshot(self):
+        return SimSnapshot(self)
+
+    def restore(self, snapshot):
+        """
+        Puts the sim back in the state of snapshot.
+
+        Box2D 2.0 keeps contact impulses, sleep timers and broadphase
+        order that cannot be read back or set, so the world is rebuilt
+        from scratch. Right after a restore the bodies, signals and
+        controls are exactly as recorded, and every restore of the same
+        snapshot, in any sim of the level, continues identically, and a
+        restored snapshot of a new sim plays exactly like a new sim.
+        Otherwise the continuation is not bit-identical to the run the
+        snapshot was taken from, which keeps its contacts; it drifts apart
+        from it within a few steps once bodies touch.
+        """
+        self.world = self.create_world()
+        self.bodies = {}
+        self.bound_forces = {}
+        # Forces and joints added by signals after the snapshot was taken
+        # are dropped with the rest of the state.
+        self.forces_by_body = defaultdict(list)
+        self.force_ids = []
+        for id in snapshot.force_ids:
+            self.add_force(self.objects[id])
+        self.joint_ids = list(snapshot.joint_ids)
+        # Create bodies in their original order, so that the world lists
+        # them in the same order as before.
+        for id in snapshot.body_ids:
+            self.create_body(self.objects[id])
+        # Joints are defined in level coordinates, so they are created
+        # before any body is moved.
+        for id in self.joint_ids:
+            joint_data = self.objects[id]
+            label = joint_data[1]
+            if label['body1'] in self.bodies and label['body2'] in self.bodies:
+                self.create_joint(joint_data)
+        state = snapshot.body_state
+        for i, id in enumerate(snapshot.body_ids):
+            body = self.bodies[id]
+            if body.IsStatic():
+                continue
+            x, y, angle, vx, vy, omega = state[6 * i:6 * i + 6]
+            body.SetXForm(b2Vec2(x, y), angle)
+            body.SetLinearVelocity(b2Vec2(vx, vy))
+            body.SetAngularVelocity(omega)
+            if snapshot.sleeping[i]:
+                body.PutToSleep()
+
+        if self.ship_id in self.bodies:
+            self.set_ship_body(self.bodies[self.ship_id])
+        self.ship.thrust, self.ship.turn_direction = snapshot.controls
+        self.steps_taken = snapshot.steps_taken
+        self.accumulated_signals = set(snapshot.accumulated_signals)
+        # The signal table is complete from the start, and the same in
+        # every sim of the level, so the listeners line up.
+        self.signal_listeners = [list(listeners)
+                                 for listeners in snapshot.signal_listeners]
+        self.game_end_status = snapshot.game_end_status
+
+    def step(self):
+        if self.profiler:
+            return self.profiled_step(self.profiler)
+        self.steps_taken += 1
+        self.ship.apply_controls()
+        self.apply_forces()
+        self.emitted_signals = set()
+        vel_iters, pos_iters = 10, 8
+        self.world.Step(self.time_step, vel_iters, pos_iters)
+        self.handle_emitted_signals()
+        if not self.is_ghost:
+            self.check_game_end_condition()
+        return self.game_end_status
+
+    def profiled_step(self, profiler):
+        """ step(), with its phases timed. Keep the two in sync. """
+        t0 = timer()
+        self.steps_taken += 1
+        self.ship.apply_controls()
+        self.apply_forces()
+        self.emitted_signals = set()
+        t1 = timer()
+        vel_iters, pos_iters = 10, 8
+        self.world.Step(self.time_step, vel_iters, pos_iters)
+        t2 = timer()
+        self.handle_emitted_signals()
+        t3 = timer()
+        if not self.is_ghost:
+            self.check_game_end_condition()
+        t4 = timer()
+        profiler.add('sim.forces', t1 - t0)
+        profiler.add('sim.world_step', t2 - t1)
+        profiler.add('sim.signals', t3 - t2)
+        profiler.add('sim.game_end', t4 - t3)
+        return self.game_end_status
+
+class SimSnapshot(object):
+    """
+    The state of a Sim at one step. The bodies that exist are stored as
+    ids in world order, and their state as a flat array with six floats
+    per body: x, y, angle, linear velocity x, y and angular velocity.
+    Bodies, forces, joints and listeners are referred to by id, and
+    looked up in the objects of the sim it is restored into, so that it
+    stays small and can be restored into any sim of the same level.
+    """
+    def __init__(self, sim):
+        self.body_ids = []
+        self.body_state = array('d')
+        self.sleeping = array('B')
+        for body in sim.world:
+            data = body.GetUserData()
+            if not data:
+                # The ground body.
+                continue
+            self.body_ids.append(data['id'])
+            x, y = body.GetPosition().tuple()
+            vx, vy = body.GetLinearVelocity().tuple()
+            self.body_state.extend((x, y, body.GetAngle(),
+                                    vx, vy, body.GetAngularVelocity()))
+            self.sleeping.append(body.IsSleeping())
+        self.force_ids = tuple(sim.force_ids)
+        self.joint_ids = tuple(sim.joint_ids)
+        self.controls = sim.ship.thrust, sim.ship.turn_direction
+        self.steps_taken = sim.steps_taken
+        self.accumulated_signals = frozenset(sim.accumulated_signals)
+        self.signal_listeners = tuple(tuple(listeners)
+                                      for listeners in sim.signal_listeners)
+        self.game_end_status = sim.game_end_status
+
+def make_sim(file_name, is_ghost=False, pack=None):
+    """ Builds a sim from a level SVG, or from the level named so in pack. """
+    if pack:
+        header, bodies = pack.read_level(file_name)
+    else:
+        header, bodies = read_level_cached(file_name)
+    return make_sim_from_level(header, bodies, is_ghost)
+
+class LevelTemplate(object):
+    """
+    A parsed level kept in memory, to build new sims from without parsing
+    it again, as when a level is restarted. The sims share the cached
+    tessellations of the shapes.
+    """
+    def __init__(self, header, bodies):
+        self.header = header
+        self.bodies = bodies
+        self.objects = level_objects(bodies)
+        self.shape_caches = {}
+
+    def make_sim(self, is_ghost=False):
+        return make_sim_from_level(self.header, self.bodies, is_ghost,
+                                   self.shape_caches, self.objects)
+
+# Bodies of a parsed level that are settings rather than objects.
+LEVEL_SETTINGS = set(['pagecolor', 'viewport', 'gravity'])
+
+def level_objects(bodies):
+    """ The bodies, forces and joints of a parsed level by id. """
+    return dict((body[0], body) for body in bodies
+                if body[0] not in LEVEL_SETTINGS and 'sound' not in body[1])
+
+def make_sim_from_level(header, bodies, is_ghost=False, shape_caches=None,
+                        objects=None):
+    """
+    Builds a sim from a parsed level. The level is not modified, so many
+    sims may be built from it.
+    """
+    sounds = []
+    joints = []
+    sim = Sim(header['width'], header['height'],
+              set(header['winning_condition']), is_ghost=is_ghost,
+              shape_caches=shape_caches)
+    sim.objects = level_objects(bodies) if objects is None else objects
+    # Number the signals before any body is created, also those of the
+    # bodies that signals create later.
+    for body in bodies:
+        if body[0] in sim.objects:
+            sim.register_signals(body[1])
+    for body in bodies:
+        body_id = body[0]
+        if body_id == 'pagecolor':
+            background = parse_hex_color(body[1])
+            continue
+        label = body[1]
+        if body_id == 'viewport':
+            viewport = body[2][0][4]
+        elif body_id == 'gravity':
+            (p1x, p1y), (p2x, p2y) = body[2][0][4]
+            x, y = p2x-p1x, p2y-p1y
+
+            sim.set_gravity((x, y))
+        elif 'revolute_joint' in label:
+            # Create joints last.
+            joints.append(body)
+        elif 'sound' in label:
+            sounds.append((label['file'], label.get('started_by', None)))
+        else:
+            added = sim.add_object(body)
+            if body_id == 'ship':
+                sim.set_ship_body(added)
+
+    for joint in joints:
+        sim.add_object(joint)
+
+    return sim, viewport, background, sounds
+
+def headless(sim, replay_stream):
+    for thrust, turn_direction in replay_stream:
+        if sim.game_end_status:
+            break
+        sim.ship.thrust = thrust
+        sim.ship.turn_direction = turn_direction
+        sim.step()
+
+def game_result(sim):
+    """ The number of steps taken if the level was completed. """
+    if sim.game_end_status == Sim.LEVEL_COMPLETED:
+        return sim.steps_taken
+    elif sim.game_end_status == Sim.GAME_OVER:
+        return 'GAME OVER'
+    else:
+        return 'ABORTED'
@@ -0,0 +1,206 @@
+from __future__ import with_statement
+
+from level_loader import read_level_cached
+from replay import CONTROL_STATES, Replay, level_hash, save_replay
+from sim import LevelTemplate, Sim, game_result, headless
+
+import multiprocessing
+import signal
+import sys
+import time
+from optparse import OptionParser
+
+# A beam search over the control states. Every search state is a sim
+# snapshot; it is expanded by holding each of the six control states for
+# a number of steps, in a process pool. To keep the beam from filling up
+# with near identical runs, at most one state is kept per grid cell of
+# ship position and set of collected winning signals, and cells that
+# have not been reached before are preferred.
+
+# Worker side
+
+worker_sim = None
+
+def init_worker(level_file_name):
+    global worker_sim
+    # Let the parent handle ^C.
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    header, bodies = read_level_cached(level_file_name)
+    worker_sim, _, _, _ = LevelTemplate(header, bodies).make_sim()
+
+def hold_control(sim, state, hold):
+    """ Steps sim with a control state for up to hold steps. """
+    sim.ship.thrust, sim.ship.turn_direction = CONTROL_STATES[state]
+    for i in xrange(hold):
+        if sim.step():
+            break
+
+def expand(job):
+    """
+    Returns (state, snapshot, status, steps, collected, ship position)
+    for each control state held from snapshot. status is 'completed',
+    'game_over' or None; only unfinished runs get a snapshot.
+    """
+    snapshot, hold, winning_condition = job
+    sim = worker_sim
+    children = []
+    for state in xrange(len(CONTROL_STATES)):
+        sim.restore(snapshot)
+        hold_control(sim, state, hold)
+        status = None
+        if sim.game_end_status == Sim.LEVEL_COMPLETED:
+            status = 'completed'
+        elif sim.game_end_status == Sim.GAME_OVER:
+            status = 'game_over'
+        children.append((state, None if status else sim.snapshot(), status,
+                         sim.steps_taken,
+                         len(winning_condition & sim.accumulated_signals),
+                         sim.ship.position))
+    return children
+
+# Search
+
+class Node(object):
+    """ A search state, and the way it was reached. """
+    def __init__(self, parent, state, steps, snapshot, collected, position):
+        self.parent = parent
+        self.state = state
+        self.steps = steps
+        self.snapshot = snapshot
+        self.collected = collected
+        self.position = position
+
+    def replay(self, level_digest):
+        nodes = []
+        node = self
+        while node.parent:
+            nodes.append(node)
+            node = node.parent
+        replay = Replay(level_digest)
+        steps = 0
+        for node in reversed(nodes):
+            replay.extend([CONTROL_STATES[node.state]] * (node.steps - steps))
+            steps = node.steps
+        return replay
+
+def select_beam(children, visited, cell_size, width):
+    """ Picks the next beam, at most one node per cell. """
+    cells = {}
+    for node in children:
+        x, y = node.position
+        cell = node.collected, int(x // cell_size), int(y // cell_size)
+        if cell not in cells:
+            cells[cell] = node
+    def priority(item):
+        cell, node = item
+        return -node.collected, cell in visited
+    ranked = sorted(cells.iteritems(), key=priority)[:width]
+    # Only the cells that are expanded. Those cut from the beam are still
+    # new when a later beam reaches them.
+    visited.update(cell for cell, _ in ranked)
+    return [node for _, node in ranked]
+
+def search(level_file_name, width=64, hold=10, max_steps=3600,
+           cell_size=5.0, processes=None, verbose=False):
+    """
+    Returns the fastest replay found that completes the level, or None,
+    and the number of sim steps that were run.
+    """
+    header, bodies = read_level_cached(level_file_name)
+    sim, _, _, _ = LevelTemplate(header, bodies).make_sim()
+    winning_condition = sim.winning_condition
+    root = Node(None, None, 0, sim.snapshot(), 0, sim.ship.position)
+    # Restore right away, so that the snapshot is on the same footing as
+    # every later restore of it.
+    sim.restore(root.snapshot)
+    level_digest = level_hash(level_file_name)
+
+    beam = [root]
+    visited = set()
+    solutions = []
+    sim_steps = 0
+    pool = multiprocessing.Pool(processes, init_worker, (level_file_name,))
+    try:
+        while beam and beam[0].steps + hold <= max_steps:
+            jobs = [(node.snapshot, hold, winning_condition) for node in beam]
+            children = []
+            for node, expanded in zip(beam, pool.imap(expand, jobs)):
+                # Only the beam needs its snapshots.
+                node.snapshot = None
+                for state, snapshot, status, steps, collected, position \
+                        in expanded:
+                    sim_steps += steps - node.steps
+                    child = Node(node, state, steps, snapshot, collected,
+                                 position)
+                    if status == 'completed':
+                        solutions.append(child)
+                    elif status is None:
+                        children.append(child)
+            if solutions:
+                # Every node of a beam has taken the same number of steps,
+                # so the first solutions found are the fastest.
+                break
+            beam = select_beam(children, visited, cell_size, width)
+            if verbose and beam:
+                print >> sys.stderr, 'step %5d: %3d states, %d collected' % (
+                    beam[0].steps, len(beam),
+                    max(node.collected for node in beam))
+    finally:
+        pool.terminate()
+        pool.join()
+
+    # Restoring a snapshot does not reproduce Box2D's internal state
+    # bit for bit, so a solution only counts if it also completes the
+    # level when replayed from the start.
+    for node in sorted(solutions, key=lambda node: node.steps):
+        replay = node.replay(level_digest)
+        fresh, _, _, _ = LevelTemplate(header, bodies).make_sim()
+        headless(fresh, replay)
+        if fresh.game_end_status == Sim.LEVEL_COMPLETED:
+            return replay, sim_steps
+        if verbose:
+            print >> sys.stderr, 'Solution in %d steps does not replay: %s' % (
+                node.steps, game_result(fresh))
+    return None, sim_steps
+
+
+def main():
+    parser = OptionParser(usage='%prog [options] LEVEL OUTPUT\n\n'
+                          'Searches for a fast run through LEVEL and saves '
+                          'it as a replay in OUTPUT.')
+    parser.add_option('-w', '--width', dest='width', type='int', default=64,
+                      help='Number of states kept per round. Default is 64.')
+    parser.add_option('--hold', dest='hold', type='int', default=10,
+                      metavar='STEPS',
+                      help='Steps a control state is held before the next '
+                           'choice. Default is 10.')
+    parser.add_option('-m', '--max-steps', dest='max_steps', type='int',
+                      default=3600, help='Give up after this many steps.')
+    parser.add_option('-c', '--cell-size', dest='cell_size', type='float',
+                      default=5.0,
+                      help='Keep one state per cell of this size, in level '
+                           'units. Default is 5.')
+    parser.add_option('-j', '--jobs', dest='jobs', type='int', default=None,
+                      help='Number of worker processes. Default is one per '
+                           'core.')
+    parser.add_option('-v', '--verbose', dest='verbose', action='store_true',
+                      help='Report progress on stderr.')
+    options, args = parser.parse_args()
+    if len(args) < 2:
+        parser.error('Level and output file names must be given. ')
+
+    start = time.time()
+    replay, sim_steps = search(args[0], options.width, options.hold,
+                               options.max_steps, options.cell_size,
+                               options.jobs, options.verbose)
+    elapsed = time.time() - start
+    print >> sys.stderr, '%d sim steps in %.1f s (%.0f steps/s)' % (
+        sim_steps, elapsed, sim_steps / elapsed)
+    if replay is None:
+        print 'No solution found'
+        sys.exit(1)
+    save_replay(args[1], replay)
+    print replay.steps
+
+if __name__ == '__main__':
+    main()
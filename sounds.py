@@ -0,0 +1,130 @@
+import multiprocessing
+import os
+import signal
+from collections import deque
+
+import pyglet
+# Imported here, so that the audio driver is set up when the game starts
+# and not by the first sound that is loaded.
+import pyglet.media
+
+# Sound files larger than this are streamed from disk as they play, the
+# others are decoded into memory once and kept for later levels.
+STREAM_SIZE_LIMIT = 512 * 1024
+
+# (absolute path, mtime) -> DecodedSource, shared by every SoundLoader of
+# the process.
+static_cache = {}
+
+# Decoder side
+
+def init_decoder():
+    # Let the game handle ^C.
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+def decode_sound(path):
+    """
+    Decodes a sound file completely, in the decoder process. The pyglet
+    and AVbin state used for it are that process's own; only the raw
+    samples and (channels, sample size, sample rate) are returned.
+    """
+    source = pyglet.media.load(path, streaming=False)
+    audio_format = source.audio_format
+    # StaticSource keeps the decoded samples in _data.
+    return source._data, (audio_format.channels, audio_format.sample_size,
+                          audio_format.sample_rate)
+
+# Main thread side
+
+class DecodedSource(pyglet.media.StaticSource):
+    """ A StaticSource over samples that were decoded elsewhere. """
+    def __init__(self, data, audio_format):
+        self.audio_format = audio_format
+        self._data = data
+        self._duration = len(data) / float(audio_format.bytes_per_second)
+
+def error_text(e):
+    return '%s: %s' % (type(e).__name__, e)
+
+def is_streaming(source):
+    return not isinstance(source, pyglet.media.StaticSource)
+
+class SoundLoader(object):
+    """
+    Loads sounds without holding up the game. pyglet media is not thread
+    safe, and decoding on another thread while the music streams can crash
+    AVbin, so no pyglet object is made or used off the main thread.
+
+    Short sounds are decoded by a separate process into raw samples, which
+    poll() wraps into sources. Long sounds are streamed as they play;
+    poll() opens one of them per call.
+    """
+    def __init__(self):
+        # Started with the first sound to decode.
+        self.decoder = None
+        # (file name, key, cache key, AsyncResult), in request order.
+        self.decoding = []
+        # (file name, key, path) of the sounds to stream.
+        self.streams = deque()
+        # (file name, key, source, error) for the next poll().
+        self.ready = []
+
+    @property
+    def pending(self):
+        """ The number of sounds requested and not yet returned by poll(). """
+        return len(self.decoding) + len(self.streams) + len(self.ready)
+
+    def load(self, file_name, key):
+        path = os.path.abspath(file_name)
+        try:
+            if os.path.getsize(path) > STREAM_SIZE_LIMIT:
+                self.streams.append((file_name, key, path))
+                return
+            cache_key = path, os.path.getmtime(path)
+        except OSError, e:
+            self.ready.append((file_name, key, None, error_text(e)))
+            return
+        source = static_cache.get(cache_key)
+        if source is not None:
+            self.ready.append((file_name, key, source, None))
+            return
+        if self.decoder is None:
+            self.decoder = multiprocessing.Pool(1, init_decoder)
+        self.decoding.append((file_name, key, cache_key,
+                              self.decoder.apply_async(decode_sound,
+                                                       (path,))))
+
+    def poll(self):
+        """
+        Returns the (file name, key, source, error) of the sounds that are
+        ready. Never waits for the decoder.
+        """
+        ready, self.ready = self.ready, []
+        decoding = []
+        for file_name, key, cache_key, result in self.decoding:
+            if not result.ready():
+                decoding.append((file_name, key, cache_key, result))
+                continue
+            try:
+                data, audio_format = result.get()
+                source = DecodedSource(data,
+                                       pyglet.media.AudioFormat(*audio_format))
+                static_cache[cache_key] = source
+                ready.append((file_name, key, source, None))
+            except Exception, e:
+                ready.append((file_name, key, None, error_text(e)))
+        self.decoding = decoding
+        if self.streams:
+            file_name, key, path = self.streams.popleft()
+            try:
+                source = pyglet.media.load(path, streaming=True)
+                ready.append((file_name, key, source, None))
+            except Exception, e:
+                ready.append((file_name, key, None, error_text(e)))
+        return ready
+
+    def close(self):
+        if self.decoder is not None:
+            self.decoder.terminate()
+            self.decoder.join()
+            self.decoder = None
@@ -0,0 +1,356 @@
+from __future__ import with_statement
+
+from level_loader import read_level_cached
+from levelpack import LevelPack, level_files, level_name
+from profiler import Profiler
+from replay import Replay, level_hash
+from sim import LevelTemplate
+from verify import WORKER_MARGIN, check_replay, init_worker
+
+import json
+import multiprocessing
+import os
+import socket
+import SocketServer
+import stat
+import sys
+import threading
+import time
+from collections import deque
+from cStringIO import StringIO
+from optparse import OptionParser
+
+# A local service that verifies uploaded replays.
+#
+# Protocol, over a Unix socket or localhost TCP: the client sends a JSON
+# request line, then for a submission the replay in the binary format,
+# and reads one JSON line back.
+#   {"level": NAME, "size": N} + N bytes -> a verify.py style record
+#   {"stats": true} -> the metrics of every level
+# Old pickle replays are not accepted; unpickling uploads is not safe.
+MAX_REPLAY_SIZE = 1 << 20
+# Seconds a client may pause while it sends its request, before the
+# connection is dropped. A stalled upload would hold a handler thread.
+READ_TIMEOUT = 10.0
+# Throughput is the rate of accepted submissions over this many seconds.
+RATE_WINDOW = 60.0
+
+# Worker side
+
+# name -> (LevelTemplate, sha1 of the level SVG), loaded once per worker.
+worker_levels = {}
+
+def level_sources(source):
+    """ Yields (name, loader of (header, bodies), digest loader). """
+    if os.path.isdir(source):
+        for file_name in level_files([source]):
+            yield (level_name(file_name),
+                   lambda file_name=file_name: read_level_cached(file_name),
+                   lambda file_name=file_name: level_hash(file_name))
+    else:
+        pack = LevelPack(source)
+        for name in pack.names():
+            yield (name, lambda name=name: pack.read_level(name),
+                   lambda name=name: pack.level_hash(name))
+
+def init_submit_worker(source):
+    init_worker()
+    for name, load, digest in level_sources(source):
+        try:
+            header, bodies = load()
+        except Exception:
+            # Submissions for it fail as an unknown level.
+            continue
+        worker_levels[name] = LevelTemplate(header, bodies), digest()
+
+def load_upload(name, data):
+    if name not in worker_levels:
+        raise KeyError('Unknown level %s' % name)
+    template, digest = worker_levels[name]
+    replay = Replay.read(StringIO(data))
+    if replay.level_hash != digest:
+        raise ValueError('Replay was recorded on another version of %s' %
+                         name)
+    return template, replay
+
+def verify_upload(job):
+    name, data, timeout = job
+    started = time.time()
+    record = check_replay(lambda: load_upload(name, data), timeout)
+    return record, started, time.time()
+
+# Server
+
+class Metrics(object):
+    """
+    Result counts, latencies and throughput per level, shared by the
+    handlers.
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counts = {}
+        self.profiler = Profiler()
+        self.started = time.time()
+        # level -> times of the submissions accepted in the last
+        # RATE_WINDOW seconds, oldest first.
+        self.accepted = {}
+
+    def accept(self, level):
+        """ Counts a submission that was handed to the verifier. """
+        with self.lock:
+            self.accepted.setdefault(level, deque()).append(time.time())
+
+    def count(self, level, result):
+        with self.lock:
+            counts = self.counts.setdefault(level, {})
+            counts[result] = counts.get(result, 0) + 1
+
+    def add_times(self, level, queued, verified):
+        with self.lock:
+            self.profiler.add('%s.queue' % level, queued)
+            self.profiler.add('%s.verify' % level, verified)
+
+    def report(self):
+        with self.lock:
+            levels = dict((level, dict(results=dict(counts)))
+                          for level, counts in self.counts.iteritems())
+            now = time.time()
+            window = max(min(RATE_WINDOW, now - self.started), 1e-3)
+            total = 0
+            for level, times in self.accepted.iteritems():
+                while times and times[0] < now - RATE_WINDOW:
+                    times.popleft()
+                levels.setdefault(level, dict(results={}))
+                levels[level]['accepted_per_s'] = len(times) / window
+                total += len(times)
+            for phase, stats in self.profiler.phases.iteritems():
+                level, kind = phase.rsplit('.', 1)
+                p50, p95, p99 = stats.percentiles()
+                levels[level]['%s_ms' % kind] = dict(
+                    mean=stats.mean * 1000, p50=p50 * 1000, p95=p95 * 1000,
+                    p99=p99 * 1000, max=stats.max * 1000)
+        return dict(levels=levels, accepted_per_s=total / window)
+
+class SubmissionHandler(SocketServer.StreamRequestHandler):
+    def handle(self):
+        server = self.server
+        self.request.settimeout(server.read_timeout)
+        try:
+            request = json.loads(self.rfile.readline())
+        except ValueError:
+            request = None
+        except socket.timeout:
+            self.reply(dict(result='ERROR', error='Timed out reading the '
+                                                  'request'))
+            return
+        if not isinstance(request, dict):
+            self.reply(dict(result='ERROR', error='Bad request'))
+            return
+        if request.get('stats'):
+            self.reply(server.metrics.report())
+            return
+
+        level = request.get('level')
+        size = request.get('size')
+        if not isinstance(size, int) or not 0 <= size <= MAX_REPLAY_SIZE:
+            self.reply(dict(result='ERROR', error='Bad replay size'))
+            return
+        try:
+            data = self.rfile.read(size)
+        except socket.timeout:
+            self.reply(dict(level=level, result='ERROR',
+                            error='Timed out reading the replay'))
+            return
+        if len(data) < size:
+            self.reply(dict(level=level, result='ERROR',
+                            error='Truncated replay'))
+            return
+        if level not in server.level_names:
+            self.reply(dict(level=level, result='ERROR',
+                            error='Unknown level %s' % level))
+            return
+
+        # Backpressure: with every worker busy and the queue full, turn
+        # the submission away instead of queueing without bound.
+        if not server.slots.acquire(False):
+            server.metrics.count(level, 'BUSY')
+            self.reply(dict(level=level, result='BUSY'))
+            return
+        server.metrics.accept(level)
+        try:
+            received = time.time()
+            pending = server.pool.apply_async(
+                verify_upload, ((level, data, server.timeout),))
+            try:
+                record, started, finished = pending.get(server.max_wait)
+            except multiprocessing.TimeoutError:
+                # The worker died, or hangs outside of the replay timeout.
+                server.metrics.count(level, 'ERROR')
+                self.reply(dict(level=level, result='ERROR',
+                                error='No result from the verifier'))
+                return
+        finally:
+            server.slots.release()
+        result = record['result']
+        server.metrics.count(level, result if isinstance(result, str)
+                                    else 'COMPLETED')
+        server.metrics.add_times(level, started - received,
+                                 finished - started)
+        record.update(level=level)
+        self.reply(record)
+
+    def reply(self, message):
+        try:
+            self.wfile.write(json.dumps(message) + '\n')
+        except socket.error:
+            # The client is gone, or stopped reading.
+            pass
+
+# A classic class, like the SocketServer classes it is mixed into.
+class SubmissionServerMixin:
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def set_up(self, source, processes=None, max_queue=64, timeout=60.0,
+               read_timeout=READ_TIMEOUT):
+        self.level_names = set(name for name, load, digest
+                               in level_sources(source))
+        self.pool = multiprocessing.Pool(processes, init_submit_worker,
+                                         (source,))
+        processes = processes or multiprocessing.cpu_count()
+        self.slots = threading.BoundedSemaphore(processes + max_queue)
+        self.timeout = timeout
+        self.read_timeout = read_timeout
+        # The longest a submission can take, queued behind a full queue
+        # of submissions that all time out.
+        rounds = -(-(processes + max_queue) // processes)
+        self.max_wait = rounds * timeout + WORKER_MARGIN
+        self.metrics = Metrics()
+
+    def close(self):
+        self.server_close()
+        self.pool.terminate()
+        self.pool.join()
+
+class UnixSubmissionServer(SubmissionServerMixin, SocketServer.ThreadingMixIn,
+                           SocketServer.UnixStreamServer):
+    pass
+
+class TCPSubmissionServer(SubmissionServerMixin, SocketServer.ThreadingMixIn,
+                          SocketServer.TCPServer):
+    pass
+
+def parse_address(address):
+    """ 'HOST:PORT' or ':PORT' for TCP, anything else is a socket path. """
+    host, sep, port = address.rpartition(':')
+    if sep and port.isdigit():
+        return host or 'localhost', int(port)
+    return address
+
+def make_server(address, source, processes=None, max_queue=64,
+                timeout=60.0, read_timeout=READ_TIMEOUT):
+    """
+    A server for the levels in source, a directory of SVGs or a level
+    pack. Run it with serve_forever(), and close() it when done.
+    """
+    address = parse_address(address)
+    if isinstance(address, tuple):
+        server = TCPSubmissionServer(address, SubmissionHandler)
+    else:
+        if os.path.exists(address):
+            # Replace a socket left behind by an earlier server, but never
+            # anything else, such as a level pack given by mistake.
+            if not stat.S_ISSOCK(os.stat(address).st_mode):
+                raise ValueError('%s exists and is not a socket' % address)
+            os.unlink(address)
+        server = UnixSubmissionServer(address, SubmissionHandler)
+    server.set_up(source, processes, max_queue, timeout, read_timeout)
+    return server
+
+# Client
+
+def request(address, message, data=''):
+    address = parse_address(address)
+    if isinstance(address, tuple):
+        sock = socket.create_connection(address)
+    else:
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.connect(address)
+    try:
+        sock.sendall(json.dumps(message) + '\n' + data)
+        f = sock.makefile('rb')
+        try:
+            return json.loads(f.readline())
+        finally:
+            f.close()
+    finally:
+        sock.close()
+
+def submit_replay(address, level, replay):
+    """ Uploads a Replay and returns the verification record. """
+    f = StringIO()
+    replay.write(f)
+    data = f.getvalue()
+    return request(address, dict(level=level, size=len(data)), data)
+
+def server_stats(address):
+    return request(address, dict(stats=True))
+
+
+def main():
+    parser = OptionParser(usage='%prog [options] LEVELS\n'
+                          '       %prog -c ADDRESS LEVEL REPLAY\n'
+                          '       %prog -c ADDRESS --stats\n\n'
+                          'Serves replay verification for the levels in '
+                          'LEVELS, a directory of level SVGs or a level '
+                          'pack, or submits a replay to a running server.')
+    parser.add_option('-a', '--address', dest='address',
+                      default='pylots-submit.sock',
+                      help='Unix socket path, or HOST:PORT to listen on '
+                           'TCP. Default is pylots-submit.sock.')
+    parser.add_option('-j', '--jobs', dest='jobs', type='int', default=None,
+                      help='Number of worker processes. Default is one per '
+                           'core.')
+    parser.add_option('-q', '--max-queue', dest='max_queue', type='int',
+                      default=64,
+                      help='Submissions waiting for a worker before new '
+                           'ones are turned away as BUSY.')
+    parser.add_option('-t', '--timeout', dest='timeout', type='float',
+                      default=60.0, metavar='SECONDS',
+                      help='Give up on a replay after SECONDS.')
+    parser.add_option('-c', '--connect', dest='connect', metavar='ADDRESS',
+                      help='Submit to the server at ADDRESS instead.')
+    parser.add_option('--stats', dest='stats', action='store_true',
+                      help='With -c, print the metrics of the server.')
+    options, args = parser.parse_args()
+
+    if options.connect:
+        if options.stats:
+            print json.dumps(server_stats(options.connect), indent=1,
+                             sort_keys=True)
+            return
+        if len(args) < 2:
+            parser.error('Level name and replay file must be given. ')
+        with open(args[1], 'rb') as f:
+            replay = Replay.read(f)
+        print json.dumps(submit_replay(options.connect, args[0], replay))
+        return
+
+    if len(args) < 1:
+        parser.error('Level directory or pack must be given. ')
+    try:
+        server = make_server(options.address, args[0], options.jobs,
+                             options.max_queue, options.timeout)
+    except ValueError, e:
+        parser.error(str(e))
+    print >> sys.stderr, 'Serving %d levels on %s' % (
+        len(server.level_names), options.address)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.close()
+
+if __name__ == '__main__':
+    main()
@@ -1,5 +1,8 @@
 
+import math
 import re
+from array import array
+from collections import defaultdict
 
 def main():
     path = "M 262.85714,266.6479 C 339.86994,315.42528 317.14286,172.36218 411.42857,258.07647"
@@ -19,8 +22,167 @@ def point_in_triangle(p1, p2, p3, p):
             return False
     return True
 
-def triangulate_path(path):
-    points = path_points(path)
+def triangulate_points(points):
+    """
+    Splits a counter clockwise polygon into triangles by ear clipping.
+    Returns a list of closed point arrays, one per triangle.
+
+    The remaining polygon is kept as a ring of prev/next indices and the
+    convexity of every vertex is cached, so clipping an ear only updates
+    its two neighbours. Only reflex vertices can lie inside an ear, and
+    they are looked up in a uniform grid. Duplicate points and collinear
+    vertices are dropped without emitting triangles.
+    """
+    xs, ys = [], []
+    for i in xrange(0, len(points), 2):
+        x, y = points[i], points[i + 1]
+        if not xs or x != xs[-1] or y != ys[-1]:
+            xs.append(x)
+            ys.append(y)
+    while len(xs) > 1 and xs[0] == xs[-1] and ys[0] == ys[-1]:
+        xs.pop()
+        ys.pop()
+    n = len(xs)
+    if n < 3:
+        return []
+
+    def turn(a, b, c):
+        # Twice the signed area of the triangle a, b, c.
+        return (xs[b] - xs[a]) * (ys[c] - ys[a]) - \
+               (ys[b] - ys[a]) * (xs[c] - xs[a])
+
+    next = range(1, n) + [0]
+    prev = [n - 1] + range(n - 1)
+    reflex = [turn(prev[i], i, next[i]) > 0 for i in xrange(n)]
+
+    # Uniform grid over the reflex vertices.
+    min_x, min_y = min(xs), min(ys)
+    size = max(max(xs) - min_x, max(ys) - min_y) or 1.0
+    cell = size / max(1, int(math.sqrt(sum(reflex))))
+    grid = defaultdict(list)
+    for i in xrange(n):
+        if reflex[i]:
+            grid[int((xs[i] - min_x) / cell),
+                 int((ys[i] - min_y) / cell)].append(i)
+
+    def is_ear(a, b, c):
+        ax, ay, bx, by, cx, cy = xs[a], ys[a], xs[b], ys[b], xs[c], ys[c]
+        corners = ((ax, ay), (bx, by), (cx, cy))
+        x0 = int((min(ax, bx, cx) - min_x) / cell)
+        x1 = int((max(ax, bx, cx) - min_x) / cell)
+        y0 = int((min(ay, by, cy) - min_y) / cell)
+        y1 = int((max(ay, by, cy) - min_y) / cell)
+        for gx in xrange(x0, x1 + 1):
+            for gy in xrange(y0, y1 + 1):
+                for p in grid.get((gx, gy), ()):
+                    if not reflex[p] or (xs[p], ys[p]) in corners:
+                        continue
+                    if turn(a, b, p) <= 0 and turn(b, c, p) <= 0 and \
+                       turn(c, a, p) <= 0:
+                        return False
+        return True
+
+    triangles = []
+    remaining = n
+    i = 0
+    visited = 0
+    force = False
+    while remaining > 3:
+        a, c = prev[i], next[i]
+        t = turn(a, i, c)
+        if t == 0 or (t < 0 and (force or is_ear(a, i, c))):
+            if t != 0:
+                triangles.append(array('d', (xs[a], ys[a], xs[i], ys[i],
+                                             xs[c], ys[c], xs[a], ys[a])))
+            next[a] = c
+            prev[c] = a
+            reflex[i] = False
+            remaining -= 1
+            for j in (a, c):
+                reflex[j] = reflex[j] and turn(prev[j], j, next[j]) > 0
+            i = c
+            visited = 0
+            force = False
+        else:
+            i = next[i]
+            visited += 1
+            if visited > remaining:
+                # No ear left, the polygon must be self intersecting.
+                # Clip the next convex vertex regardless, or give up if
+                # there is none.
+                if force:
+                    break
+                force = True
+                visited = 0
+    if remaining == 3:
+        a, c = prev[i], next[i]
+        if turn(a, i, c) < 0:
+            triangles.append(array('d', (xs[a], ys[a], xs[i], ys[i],
+                                         xs[c], ys[c], xs[a], ys[a])))
+    return triangles
+
+# Box2D's b2_maxPolygonVertices.
+MAX_POLYGON_VERTICES = 8
+
+def merge_triangles(triangles, max_vertices=MAX_POLYGON_VERTICES):
+    """
+    Hertel-Mehlhorn: merges the triangles from triangulate_points() into
+    fewer convex polygons by removing diagonals that are not needed for
+    convexity. Longer diagonals are tried first, and no polygon gets
+    more than max_vertices vertices. Returns a list of closed point
+    arrays.
+    """
+    polygons = {}
+    edges = {}
+    def add_polygon(key, polygon):
+        polygons[key] = polygon
+        n = len(polygon)
+        for i in xrange(n):
+            edges[polygon[i], polygon[(i + 1) % n]] = key
+
+    for key, t in enumerate(triangles):
+        add_polygon(key, point_tuples(t)[:-1])
+
+    def is_convex(polygon):
+        n = len(polygon)
+        return all(polygon_area(polygon[i - 1], polygon[i],
+                                polygon[(i + 1) % n]) < 0
+                   for i in xrange(n))
+
+    def length(edge):
+        (px, py), (qx, qy) = edge
+        return (qx - px) ** 2 + (qy - py) ** 2
+
+    diagonals = [(p, q) for p, q in edges if (q, p) in edges and p < q]
+    diagonals.sort(key=length, reverse=True)
+    next_key = len(triangles)
+    for p, q in diagonals:
+        a, b = edges[p, q], edges[q, p]
+        if a == b:
+            continue
+        pa, pb = polygons[a], polygons[b]
+        if len(pa) + len(pb) - 2 > max_vertices:
+            continue
+        # Rotate a to run from q to p and b to run from p to q.
+        i = pa.index(q)
+        j = pb.index(p)
+        merged = pa[i:] + pa[:i] + (pb[j:] + pb[:j])[1:-1]
+        if not is_convex(merged):
+            continue
+        del polygons[a], polygons[b]
+        del edges[p, q], edges[q, p]
+        add_polygon(next_key, merged)
+        next_key += 1
+
+    return [array('d', sum(polygon + [polygon[0]], ()))
+            for key, polygon in sorted(polygons.items())]
+
+def triangulate_points_reference(points):
+    """
+    The original O(n^3) ear clipper. It is kept as a reference for
+    benchmarks only; it never terminates on degenerate polygons.
+    """
+    points = point_tuples(points)
     if points[0] == points[-1]:
         points = points[:-1]
     triangles = []
@@ -34,96 +196,153 @@ def triangulate_path(path):
                                          for p in points
                                          if p not in tri):
                 del points[i]
-                triangles.append((lp, cp, rp, lp))
+                triangles.append(array('d', lp + cp + rp + lp))
                 break
 
+    return triangles
+
+def triangulate_path(path):
+    triangles = triangulate_points(path_to_points(path))
     return ' '.join(points_path(t, closed=True) for t in triangles)
 
-def linearize_path(path):
+# The default maximum distance between a flattened curve and the real one.
+DEFAULT_FLATNESS = 0.1
+# The finest flatness allowed; anything finer only adds segments.
+MIN_FLATNESS = 0.001
+
+def linearize_points(path, flatness=DEFAULT_FLATNESS, stats=None):
     """
-    Creates a path with only M and L. 
-    In path can contain M, L and C. 
+    Tokenizes a path containing M, L, C and z and flattens it to a point
+    array [x0, y0, x1, y1, ...]. Returns the points and whether the path
+    is closed.
+
+    Curves are flattened to within flatness of the real curve. Runs of
+    curves are collected and flattened as one batch. If stats is given,
+    its 'curves' and 'curve_segments' counters are updated.
     """
-    new_path = []
+    points = array('d')
+    controls = array('d')
+    closed = False
     for type, cs in get_path(path):
-        if type == 'M':
+        closed = False
+        if type != 'C' and controls:
+            flatten_cubics(controls, flatness, points, stats)
+            del controls[:]
+        if type == 'M' or type == 'L':
             last_p = cs.next()
-            new_path.append('M %f,%f' % (last_p))
-        elif type == 'L':
-            last_p = cs.next()
-            new_path.append('L %f,%f' % (last_p))
+            points.extend(last_p)
         elif type == 'C':
-            control_points = [last_p] + list(cs)
-            for p in bezier_points(control_points):
-                new_path.append('L %f,%f' % (p))
-            last_p = control_points[-1]
+            # A C command may hold several curves, three points each.
+            cs = list(cs)
+            for i in xrange(0, len(cs) - 2, 3):
+                controls.extend(last_p)
+                for p in cs[i:i + 3]:
+                    controls.extend(p)
+                last_p = cs[i + 2]
         elif type == 'z':
-            new_path.append('z')
-    return ' '.join(new_path)
+            closed = True
+    if controls:
+        flatten_cubics(controls, flatness, points, stats)
+    return points, closed
+
+def linearize_path(path, flatness=DEFAULT_FLATNESS):
+    """
+    Creates a path with only M and L. 
+    In path can contain M, L and C. 
+    """
+    points, closed = linearize_points(path, flatness)
+    return points_path(points, closed)
+
+def cubic_steps(x0, y0, x1, y1, x2, y2, x3, y3, flatness):
+    """
+    The number of uniform steps that keeps a cubic within flatness of its
+    polyline (Wang's formula).
+    """
+    ddx = max(abs(x0 - 2 * x1 + x2), abs(x1 - 2 * x2 + x3))
+    ddy = max(abs(y0 - 2 * y1 + y2), abs(y1 - 2 * y2 + y3))
+    d = math.sqrt(ddx * ddx + ddy * ddy)
+    return max(1, int(math.ceil(math.sqrt(0.75 * d / flatness))))
+
+def flatten_cubics(controls, flatness, points, stats=None):
+    """
+    Flattens a batch of cubic curves. controls holds 8 floats, the four
+    control points, per curve. The points after each start point are
+    appended to points.
+    """
+    n_segments = 0
+    for i in xrange(0, len(controls), 8):
+        c = controls[i:i + 8]
+        steps = cubic_steps(*(tuple(c) + (flatness,)))
+        points.extend(cubic_points(c, steps))
+        n_segments += steps
+    if stats is not None:
+        stats['curves'] = stats.get('curves', 0) + len(controls) // 8
+        stats['curve_segments'] = stats.get('curve_segments', 0) + n_segments
+
+def cubic_points(c, steps):
+    """
+    Evaluates a cubic at steps uniform steps by forward differencing.
+    http://www.niksula.cs.hut.fi/~hkankaan/Homepages/bezierfast.html
+    Returns a point array without the start point.
+    """
+    x0, y0, x1, y1, x2, y2, x3, y3 = c
+    t = 1.0 / steps
+    t2 = t * t
+    t3 = t2 * t
+
+    fx, fy = x0, y0
+    fdx, fdy = 3 * (x1 - x0) * t, 3 * (y1 - y0) * t
+    fdd2x = 3 * (x0 - 2 * x1 + x2) * t2
+    fdd2y = 3 * (y0 - 2 * y1 + y2) * t2
+    fddd2x = 3 * (3 * (x1 - x2) + x3 - x0) * t3
+    fddd2y = 3 * (3 * (y1 - y2) + y3 - y0) * t3
+    fdddx, fdddy = 2 * fddd2x, 2 * fddd2y
+    fddx, fddy = 2 * fdd2x, 2 * fdd2y
+    fddd6x, fddd6y = fddd2x / 3.0, fddd2y / 3.0
+
+    points = array('d')
+    for i in xrange(steps - 1):
+        fx += fdx + fdd2x + fddd6x
+        fy += fdy + fdd2y + fddd6y
+        points.append(fx)
+        points.append(fy)
+        fdx += fddx + fddd2x
+        fdy += fddy + fddd2y
+        fddx += fdddx
+        fddy += fdddy
+        fdd2x += fddd2x
+        fdd2y += fddd2y
+    # End exactly on the last control point.
+    points.append(x3)
+    points.append(y3)
+    return points
 
 def bezier_points(p, steps = 10):
-    class SimpleVector(object):
-        def __init__(self, x, y):
-            self.x = x
-            self.y = y
-
-        def __add__(self, other):
-            return self.__class__(self.x + other.x, self.y + other.y)
-
-        def __sub__(self, other):
-            return self.__class__(self.x - other.x, self.y - other.y)
-
-        def __mul__(self, k):
-            return self.__class__(k * self.x, k * self.y)
-
-        def __iadd__(self, other):
-            self.x += other.x
-            self.y += other.y
-            return self
-
-        def __isub__(self, other):
-            self.x -= other.x
-            self.y -= other.y
-            return self
-
-        __rmul__ = __mul__
-    
-    def bezier_iter(p, steps):
-        """
-        http://www.niksula.cs.hut.fi/~hkankaan/Homepages/bezierfast.html
-        """
-        t = 1.0 / steps
-        t2 = t*t
-    
-        p0, p1, p2, p3 = p
-        f = p0
-        fd = 3 * (p1 - p0) * t
-        fdd_per_2 = 3 * (p0 - 2 * p1 + p2) * t2
-        fddd_per_2 = 3 * (3 * (p1 - p2) + p3 - p0) * t2 * t
-    
-        fddd = fddd_per_2 + fddd_per_2
-        fdd = fdd_per_2 + fdd_per_2
-        fddd_per_6 = fddd_per_2 * (1.0 / 3)
-    
-        for x in xrange(steps):
-            f += fd + fdd_per_2 + fddd_per_6
-            yield f
-            fd += fdd + fddd_per_2
-            fdd += fddd
-            fdd_per_2 += fddd_per_2
-
-    p = [SimpleVector(*t) for t in p]
-    return ((p.x, p.y) for p in bezier_iter(p, steps))
+    c = array('d')
+    for point in p:
+        c.extend(point)
+    return point_tuples(cubic_points(c, steps))
 
 def path_points(path):
     points = [tuple(map(float, e.split(',')))
               for e in path.split() if len(e) > 1]
     return points
 
+def path_to_points(path):
+    points = array('d')
+    for e in path.split():
+        if len(e) > 1:
+            points.extend(map(float, e.split(',')))
+    return points
+
+def point_tuples(points):
+    """ Converts a point array to a list of (x, y) tuples. """
+    return zip(points[0::2], points[1::2])
+
 def points_path(points, closed=False):
-    path = ['M %f,%f' % (points[0])]
-    for point in points[1:]:
-        path.append('L %f,%f' % point)
+    path = ['M %f,%f' % (points[0], points[1])]
+    for i in xrange(2, len(points), 2):
+        path.append('L %f,%f' % (points[i], points[i + 1]))
     if closed:
         path.append('z')
     return ' '.join(path)
@@ -138,20 +357,16 @@ def get_path(path):
 def split_paths(jumping_path):
     return ['M%s' % p for p in jumping_path.split('M')[1:]]
 
+def reverse_points(points):
+    reversed_points = array('d')
+    for i in xrange(len(points) - 2, -1, -2):
+        reversed_points.extend((points[i], points[i + 1]))
+    return reversed_points
+
 def reverse_path(path):
-    new_type = 'M'
-    closed = False
-    new_path = []
-    for type, cs in reversed(list(get_path(path))):
-        if type == 'z':
-            closed = True
-        else:
-            x, y = cs.next()
-            new_path.append('%s %f,%f' % (new_type, x, y))
-            new_type = 'L'
-    if closed:
-        new_path.append('z')
-    return ' '.join(new_path)
+    points = path_to_points(path)
+    closed = path.split()[-1] == 'z'
+    return points_path(reverse_points(points), closed)
 
 def polygon_area(*points):
     """
@@ -166,8 +381,17 @@ def polygon_area(*points):
         a += x * ny - nx * y
     return a / 2.0
 
+def points_area(points):
+    """ The signed area of a point array. See polygon_area(). """
+    n = len(points)
+    a = 0
+    for i in xrange(0, n, 2):
+        j = (i + 2) % n
+        a += points[i] * points[j + 1] - points[j] * points[i + 1]
+    return a / 2.0
+
 def path_area(path):
-    return polygon_area(*path_points(path))
+    return points_area(path_to_points(path))
 
 
 if __name__ == '__main__':
@@ -0,0 +1,46 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+from replay import Replay, level_hash, save_replay
+
+try:
+    import Box2D
+except ImportError:
+    Box2D = None
+else:
+    from ghost import TRACK_SUFFIX, load_pose_track
+    from test_sim import random_controls
+
+LEVEL = 'level0.svg'
+
+@unittest.skipIf(Box2D is None, 'Box2D is not installed')
+class PoseTrackCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.replay_file = os.path.join(self.dir, 'run.replay')
+        replay = Replay(level_hash(LEVEL))
+        replay.extend(random_controls(100))
+        save_replay(self.replay_file, replay)
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_truncated_track_is_recomputed(self):
+        track = load_pose_track(LEVEL, self.replay_file)
+        track_file = self.replay_file + TRACK_SUFFIX
+        with open(track_file, 'rb') as f:
+            data = f.read()
+        # Cut in the header, the body ids and the poses.
+        for size in (10, 100, len(data) - 1):
+            with open(track_file, 'wb') as f:
+                f.write(data[:size])
+            reloaded = load_pose_track(LEVEL, self.replay_file)
+            self.assertEqual(reloaded.body_ids, track.body_ids)
+            self.assertEqual(reloaded.poses, track.poses)
+        self.assertEqual(sorted(os.listdir(self.dir)),
+                         ['run.replay', 'run.replay' + TRACK_SUFFIX])
+
+if __name__ == '__main__':
+    unittest.main()
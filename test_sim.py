@@ -0,0 +1,177 @@
+import cPickle as pickle
+import random
+import unittest
+
+from level_loader import read_level
+from replay import CONTROL_STATES
+
+try:
+    import Box2D
+except ImportError:
+    Box2D = None
+else:
+    from sim import LevelTemplate, game_result
+
+def load_template(file_name):
+    # read_level and not read_level_cached, to leave no cache behind.
+    with open(file_name, 'rb') as f:
+        return LevelTemplate(*read_level(f))
+
+def random_controls(steps, seed=0):
+    """ Controls held for random stretches, like a player's. """
+    rnd = random.Random(seed)
+    controls = []
+    while len(controls) < steps:
+        controls.extend([rnd.choice(CONTROL_STATES)] * rnd.randint(5, 60))
+    return controls[:steps]
+
+def run(sim, controls):
+    """ Steps sim with controls, and returns the body state of every step. """
+    states = []
+    for thrust, turn_direction in controls:
+        if sim.game_end_status:
+            break
+        sim.ship.thrust, sim.ship.turn_direction = thrust, turn_direction
+        sim.step()
+        states.append(sim.snapshot().body_state.tolist())
+    return states
+
+def first_difference(states1, states2):
+    """ The first step where two runs differ, or None. """
+    for step, (state1, state2) in enumerate(zip(states1, states2)):
+        if state1 != state2:
+            return step
+    if len(states1) != len(states2):
+        return min(len(states1), len(states2))
+    return None
+
+def signal_level():
+    """
+    A level where a sensor under the ship emits 'on' in the first step,
+    which creates a force on a box and a joint holding the box.
+    """
+    style = {'fill': '#808080', 'stroke': '#808080'}
+    def rect(id, label, left, lower, width, height):
+        return (id, label, [('rect', id, label, style,
+                             ((left, lower), (width, height)))])
+    force_label = {'applies_force': 'box', 'created_by': 'on',
+                   'multiplier': '10'}
+    joint_label = {'revolute_joint': True, 'body1': 'box',
+                   'body2': 'anchor', 'created_by': 'on'}
+    header = dict(width=200.0, height=200.0, winning_condition=['never'])
+    bodies = [('pagecolor', '#000000'),
+              ('viewport', {}, [('rect', 'viewport', {}, style,
+                                 ((0, 0), (100, 100)))]),
+              rect('ship', {'density': '1'}, 10, 100, 4, 4),
+              rect('switch', {'sensor': True, 'ship_triggers': 'on'},
+                   5, 95, 20, 20),
+              rect('box', {'density': '1'}, 50, 50, 5, 5),
+              rect('anchor', {}, 60, 50, 5, 5),
+              ('force', force_label,
+               [('path', 'force', force_label, style, ((0, 0), (0, 1)))]),
+              ('hinge', joint_label,
+               [('circle', 'hinge', joint_label, style,
+                 ((55, 52), (1, 1)))])]
+    return LevelTemplate(header, bodies)
+
+@unittest.skipIf(Box2D is None, 'Box2D is not installed')
+class SnapshotTest(unittest.TestCase):
+    level = 'level0.svg'
+
+    def setUp(self):
+        self.template = load_template(self.level)
+        self.controls = random_controls(400)
+
+    def test_restore_puts_back_recorded_state(self):
+        sim = self.template.make_sim()[0]
+        run(sim, self.controls[:100])
+        snapshot = sim.snapshot()
+        run(sim, self.controls[100:200])
+        sim.restore(snapshot)
+        restored = sim.snapshot()
+        self.assertEqual(restored.body_ids, snapshot.body_ids)
+        self.assertEqual(restored.body_state.tolist(),
+                         snapshot.body_state.tolist())
+        self.assertEqual(restored.sleeping.tolist(),
+                         snapshot.sleeping.tolist())
+        self.assertEqual(restored.accumulated_signals,
+                         snapshot.accumulated_signals)
+        self.assertEqual(restored.signal_listeners,
+                         snapshot.signal_listeners)
+        self.assertEqual(restored.steps_taken, snapshot.steps_taken)
+
+    def test_restores_continue_identically(self):
+        sim = self.template.make_sim()[0]
+        run(sim, self.controls[:100])
+        snapshot = sim.snapshot()
+        run(sim, self.controls[100:250])
+        sim.restore(snapshot)
+        # And into another sim of the level, as the solver workers do.
+        other = self.template.make_sim()[0]
+        other.restore(snapshot)
+        self.assertEqual(first_difference(run(sim, self.controls[100:]),
+                                          run(other, self.controls[100:])),
+                         None)
+
+    def test_signal_table_is_complete_when_loaded(self):
+        sim = self.template.make_sim()[0]
+        names = list(sim.signal_names)
+        run(sim, self.controls)
+        self.assertEqual(sim.signal_names, names)
+        self.assertEqual(len(sim.signal_listeners), len(names))
+        self.assertEqual(self.template.make_sim()[0].signal_names, names)
+
+    def test_restore_reuses_shape_caches(self):
+        sim = self.template.make_sim()[0]
+        run(sim, self.controls[:100])
+        # Pickled, as snapshots travel to and from the solver workers.
+        snapshot = pickle.loads(pickle.dumps(sim.snapshot(), 2))
+        caches = len(self.template.shape_caches)
+        for i in xrange(3):
+            sim.restore(snapshot)
+            self.template.make_sim()[0].restore(snapshot)
+        self.assertEqual(len(self.template.shape_caches), caches)
+
+    def test_restored_start_plays_like_a_new_sim(self):
+        # Nothing touches yet in a new sim, so restoring its snapshot loses
+        # nothing: a replay reaches the same states and result as in a new
+        # sim of the level.
+        fresh = self.template.make_sim()[0]
+        expected = run(fresh, self.controls)
+        sim = self.template.make_sim()[0]
+        start = sim.snapshot()
+        run(sim, self.controls[:200])
+        sim.restore(start)
+        self.assertEqual(first_difference(run(sim, self.controls), expected),
+                         None)
+        self.assertEqual(game_result(sim), game_result(fresh))
+        self.assertEqual(sim.steps_taken, fresh.steps_taken)
+
+class SnapshotRaceOfSpadesTest(SnapshotTest):
+    # Checkpoints that signals create and destroy.
+    level = 'race_of_spades.svg'
+
+@unittest.skipIf(Box2D is None, 'Box2D is not installed')
+class CreatedObjectsTest(unittest.TestCase):
+    def test_restore_drops_created_forces_and_joints(self):
+        sim = signal_level().make_sim()[0]
+        snapshot = sim.snapshot()
+        sim.step()
+        self.assertTrue('on' in sim.accumulated_signals)
+        self.assertEqual(sim.force_ids, ['force'])
+        self.assertEqual(sim.world.GetJointCount(), 1)
+
+        sim.restore(snapshot)
+        self.assertEqual(sim.force_ids, [])
+        self.assertEqual(len(sim.forces_by_body['box']), 0)
+        self.assertEqual(sim.bound_forces, {})
+        self.assertEqual(sim.world.GetJointCount(), 0)
+
+        # The signal is emitted again, and creates them once.
+        sim.step()
+        self.assertEqual(sim.force_ids, ['force'])
+        self.assertEqual(len(sim.forces_by_body['box']), 1)
+        self.assertEqual(sim.world.GetJointCount(), 1)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,127 @@
+import json
+import os
+import shutil
+import socket
+import tempfile
+import threading
+import unittest
+
+from replay import Replay, level_hash
+
+try:
+    import Box2D
+except ImportError:
+    Box2D = None
+else:
+    from sim import game_result, headless
+    from submit import make_server, request, server_stats, submit_replay
+    from test_sim import load_template, random_controls
+
+LEVEL = 'level0.svg'
+
+@unittest.skipIf(Box2D is None, 'Box2D is not installed')
+class SubmitTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        shutil.copy(LEVEL, self.dir)
+        self.level_file = os.path.join(self.dir, LEVEL)
+        self.address = os.path.join(self.dir, 'submit.sock')
+        self.server = make_server(self.address, self.dir, processes=1,
+                                  timeout=10.0, read_timeout=1.0)
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.close()
+        self.thread.join()
+        shutil.rmtree(self.dir)
+
+    def replay(self, steps=300):
+        replay = Replay(level_hash(self.level_file))
+        replay.extend(random_controls(steps))
+        return replay
+
+    def test_submissions(self):
+        replay = self.replay()
+        sim = load_template(LEVEL).make_sim()[0]
+        headless(sim, replay)
+        record = submit_replay(self.address, 'level0', replay)
+        self.assertEqual(record, dict(level='level0',
+                                      result=game_result(sim),
+                                      steps_taken=sim.steps_taken))
+
+        stale = Replay('\1' * 20)
+        stale.extend(random_controls(10))
+        record = submit_replay(self.address, 'level0', stale)
+        self.assertEqual(record['result'], 'ERROR')
+        self.assertTrue('another version' in record['error'])
+
+        old = self.replay(10)
+        old.versions = (1, 1)
+        record = submit_replay(self.address, 'level0', old)
+        self.assertEqual(record['result'], 'ERROR')
+        self.assertTrue('loader version 1' in record['error'])
+
+        record = request(self.address, dict(level='level0', size=7),
+                         'garbage')
+        self.assertEqual(record['result'], 'ERROR')
+
+        record = submit_replay(self.address, 'nowhere', replay)
+        self.assertEqual(record['result'], 'ERROR')
+        self.assertTrue('Unknown level' in record['error'])
+
+        stats = server_stats(self.address)
+        self.assertEqual(stats['levels'].keys(), ['level0'])
+        level_stats = stats['levels']['level0']
+        counts = {'ERROR': 3}
+        result = game_result(sim)
+        key = result if isinstance(result, str) else 'COMPLETED'
+        counts[key] = counts.get(key, 0) + 1
+        self.assertEqual(level_stats['results'], counts)
+        self.assertEqual(sorted(level_stats['verify_ms']),
+                         ['max', 'mean', 'p50', 'p95', 'p99'])
+        # Every submission for a known level reached the verifier.
+        self.assertTrue(level_stats['accepted_per_s'] > 0.0)
+        self.assertEqual(stats['accepted_per_s'],
+                         level_stats['accepted_per_s'])
+
+    def test_stalled_upload(self):
+        # The client announces a replay and never sends it.
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.connect(self.address)
+        try:
+            sock.sendall(json.dumps(dict(level='level0', size=100)) + '\n')
+            f = sock.makefile('rb')
+            record = json.loads(f.readline())
+            f.close()
+        finally:
+            sock.close()
+        self.assertEqual(record['result'], 'ERROR')
+        self.assertEqual(record['error'], 'Timed out reading the replay')
+
+    def test_lost_result(self):
+        # As if the worker died: the handler gives up instead of holding
+        # its slot forever.
+        self.server.max_wait = 0.0
+        record = submit_replay(self.address, 'level0', self.replay(5000))
+        self.assertEqual(record['result'], 'ERROR')
+        self.assertEqual(record['error'], 'No result from the verifier')
+
+@unittest.skipIf(Box2D is None, 'Box2D is not installed')
+class AddressTest(unittest.TestCase):
+    def test_only_sockets_are_replaced(self):
+        dir = tempfile.mkdtemp()
+        try:
+            path = os.path.join(dir, 'levels.pack')
+            with open(path, 'wb') as f:
+                f.write('pack')
+            self.assertRaises(ValueError, make_server, path, dir)
+            with open(path, 'rb') as f:
+                self.assertEqual(f.read(), 'pack')
+        finally:
+            shutil.rmtree(dir)
+
+if __name__ == '__main__':
+    unittest.main()
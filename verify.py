@@ -0,0 +1,138 @@
+from __future__ import with_statement
+
+from level_loader import read_level_cached
+from sim import LevelTemplate, game_result, headless
+from replay import check_versions, load_replay
+
+import json
+import multiprocessing
+import signal
+import sys
+from optparse import OptionParser
+
+# Seconds to wait for a result beyond the replay timeout, before giving up
+# on a worker that died, or hangs where SIGALRM cannot interrupt it, like
+# inside Box2D.
+WORKER_MARGIN = 10.0
+
+# Worker side
+
+class ReplayTimeout(Exception):
+    pass
+
+def raise_timeout(signum, frame):
+    raise ReplayTimeout()
+
+# Parsed levels of this worker process, as sim.LevelTemplates.
+level_cache = {}
+
+def init_worker():
+    signal.signal(signal.SIGALRM, raise_timeout)
+    # Let the parent handle ^C.
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+def load_level(file_name):
+    if file_name not in level_cache:
+        header, bodies = read_level_cached(file_name)
+        level_cache[file_name] = LevelTemplate(header, bodies)
+    return level_cache[file_name]
+
+def check_replay(load, timeout):
+    """
+    Runs the replay on the level template that load() returns as
+    (template, replay), and returns the result fields of a record. Any
+    error, also in load() or a replay of another loader or sim version, is
+    a result.
+    """
+    signal.setitimer(signal.ITIMER_REAL, timeout)
+    try:
+        template, replay = load()
+        check_versions(replay)
+        sim, _, _, _ = template.make_sim()
+        headless(sim, replay)
+        return dict(result=game_result(sim), steps_taken=sim.steps_taken)
+    except ReplayTimeout:
+        return dict(result='TIMEOUT')
+    except Exception, e:
+        return dict(result='ERROR', error='%s: %s' % (type(e).__name__, e))
+    finally:
+        signal.setitimer(signal.ITIMER_REAL, 0)
+
+def verify_replay(job):
+    level_file, replay_file, timeout = job
+    record = dict(level=level_file, replay=replay_file)
+    record.update(check_replay(lambda: (load_level(level_file),
+                                        load_replay(replay_file)),
+                               timeout))
+    return record
+
+# Batch
+
+def read_manifest(file):
+    """ One 'LEVEL REPLAY' pair per line. Lines starting with # are ignored. """
+    for line in file:
+        line = line.strip()
+        if line and not line.startswith('#'):
+            level_file, replay_file = line.split(None, 1)
+            yield level_file, replay_file
+
+def verify_batch(pairs, out, processes=None, timeout=60.0):
+    """
+    Verifies (level, replay) pairs in a process pool and writes one JSON
+    line per replay to out, in manifest order. A replay without a result
+    WORKER_MARGIN seconds after its timeout is an ERROR; the pool is then
+    replaced, and the replays after it are verified again.
+    """
+    jobs = [(level_file, replay_file, timeout)
+            for level_file, replay_file in pairs]
+    done = 0
+    while done < len(jobs):
+        pool = multiprocessing.Pool(processes, init_worker)
+        try:
+            results = pool.imap(verify_replay, jobs[done:])
+            while done < len(jobs):
+                # In manifest order, so this replay started at the latest
+                # when the one before it finished.
+                lost = False
+                try:
+                    record = results.next(timeout + WORKER_MARGIN)
+                except multiprocessing.TimeoutError:
+                    level_file, replay_file, _ = jobs[done]
+                    record = dict(level=level_file, replay=replay_file,
+                                  result='ERROR',
+                                  error='No result from the verifier')
+                    lost = True
+                out.write(json.dumps(record) + '\n')
+                out.flush()
+                done += 1
+                if lost:
+                    break
+        finally:
+            pool.terminate()
+            pool.join()
+
+
+def main():
+    parser = OptionParser(usage='%prog [options] MANIFEST\n\n'
+                          'Verifies the replays in MANIFEST, one '
+                          '"LEVEL REPLAY" pair per line. Use - to read '
+                          'the manifest from stdin.')
+    parser.add_option('-j', '--jobs', dest='jobs', type='int', default=None,
+                      help='Number of worker processes. Default is one per '
+                           'core.')
+    parser.add_option('-t', '--timeout', dest='timeout', type='float',
+                      default=60.0, metavar='SECONDS',
+                      help='Give up on a replay after SECONDS.')
+    options, args = parser.parse_args()
+    if len(args) < 1:
+        parser.error('Manifest file name must be given. ')
+
+    if args[0] == '-':
+        pairs = list(read_manifest(sys.stdin))
+    else:
+        with open(args[0]) as f:
+            pairs = list(read_manifest(f))
+    verify_batch(pairs, sys.stdout, options.jobs, options.timeout)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,788 @@
+from __future__ import with_statement
+
+import math
+import sys
+from collections import defaultdict
+
+from profiler import Profiler, timer
+from sounds import SoundLoader, is_streaming
+
+from Box2D import e_circleShape, e_edgeShape, e_polygonShape
+import pyglet
+from pyglet.gl import *
+
+# Curved shapes are tessellated so that they stay within LOD_PIXEL_ERROR
+# pixels of the real shape on screen. Tessellations are precomputed per
+# shape for error levels that are powers of two, in level units.
+LOD_PIXEL_ERROR = 0.5
+MIN_CIRCLE_SEGMENTS = 8
+MAX_CIRCLE_SEGMENTS = 100
+
+def lod_level(pixels_per_unit):
+    """ The error level, log2 of the allowed error in level units. """
+    return int(math.floor(math.log(LOD_PIXEL_ERROR / pixels_per_unit, 2)))
+
+def circle_segments(radius, max_error):
+    if max_error >= radius:
+        return MIN_CIRCLE_SEGMENTS
+    n = int(math.ceil(math.pi / math.acos(1 - max_error / radius)))
+    return max(MIN_CIRCLE_SEGMENTS, min(MAX_CIRCLE_SEGMENTS, n))
+
+def simplify_polyline(vertices, max_error):
+    """ Douglas-Peucker on a flat vertex list. """
+    n = len(vertices) // 2
+    if n < 3:
+        return vertices
+    keep = [False] * n
+    keep[0] = keep[-1] = True
+    stack = [(0, n - 1)]
+    while stack:
+        first, last = stack.pop()
+        ax, ay = vertices[2 * first], vertices[2 * first + 1]
+        dx = vertices[2 * last] - ax
+        dy = vertices[2 * last + 1] - ay
+        length = math.hypot(dx, dy)
+        worst, worst_i = max_error, None
+        for i in xrange(first + 1, last):
+            px, py = vertices[2 * i] - ax, vertices[2 * i + 1] - ay
+            if length:
+                d = abs(dx * py - dy * px) / length
+            else:
+                d = math.hypot(px, py)
+            if d > worst:
+                worst, worst_i = d, i
+        if worst_i is not None:
+            keep[worst_i] = True
+            stack.append((first, worst_i))
+            stack.append((worst_i, last))
+    simplified = []
+    for i in xrange(n):
+        if keep[i]:
+            simplified.extend((vertices[2 * i], vertices[2 * i + 1]))
+    return simplified
+
+def shape_geometry(shape, level):
+    """
+    Tessellates a shape in body coordinates for an error level. Returns
+    the GL mode, the vertices as a flat list and the indices, or None for
+    non-indexed geometry. Tessellations are cached in the shape user data.
+    """
+    shape_data = shape.GetUserData()
+    cache = shape_data.setdefault('tessellations', {})
+    type = shape.GetType()
+    if type == e_polygonShape:
+        # Polygons look the same at every level.
+        level = None
+    if level not in cache:
+        cache[level] = tessellate_shape(shape, type, 2.0 ** (level or 0))
+    return cache[level]
+
+def tessellate_shape(shape, type, max_error):
+    if type == e_circleShape:
+        circle = shape.asCircle()
+        x, y = circle.GetLocalPosition().tuple()
+        radius = circle.GetRadius()
+        segments = circle_segments(radius, max_error)
+        vertices = [x, y]
+        for i in xrange(segments):
+            f = i / float(segments) * 2 * math.pi
+            vertices.extend((x + math.cos(f) * radius,
+                             y + math.sin(f) * radius))
+        return GL_TRIANGLES, vertices, fan_indices(segments + 1, closed=True)
+    elif type == e_polygonShape:
+        vertices = []
+        for v in shape.asPolygon().getVertices_tuple():
+            vertices.extend(v)
+        return GL_TRIANGLES, vertices, fan_indices(len(vertices) // 2)
+    elif type == e_edgeShape:
+        # An edge chain is a connected polyline, simplify it as one.
+        edge = shape.asEdge()
+        vertices = list(edge.GetVertex1().tuple())
+        while edge:
+            vertices.extend(edge.GetVertex2().tuple())
+            edge = edge.GetNextEdge()
+        vertices = simplify_polyline(vertices, max_error)
+        # As GL_LINES pairs.
+        lines = []
+        for i in xrange(0, len(vertices) - 2, 2):
+            lines.extend(vertices[i:i + 4])
+        return GL_LINES, lines, None
+
+def fan_indices(n, closed=False):
+    """ Triangle indices for a fan around vertex 0 over n vertices. """
+    indices = []
+    for i in xrange(1, n - 1):
+        indices.extend((0, i, i + 1))
+    if closed:
+        indices.extend((0, n - 1, 1))
+    return indices
+
+def transform_vertices(vertices, position, angle):
+    x0, y0 = position
+    c, s = math.cos(angle), math.sin(angle)
+    transformed = []
+    for i in xrange(0, len(vertices), 2):
+        x, y = vertices[i], vertices[i + 1]
+        transformed.extend((x0 + c * x - s * y, y0 + s * x + c * y))
+    return transformed
+
+def body_geometry(body_data, level):
+    """ Yields the colour and geometry of the visible shapes of a body. """
+    for shape in body_data['shapes']:
+        if not shape:
+            continue
+        shape_data = shape.GetUserData()
+        if shape_data.get('invisible', False):
+            continue
+        yield shape_data['color'], shape_geometry(shape, level)
+
+def add_geometry(batch, geometry, color_transform):
+    """ Adds body geometry to batch. Returns the vertex lists. """
+    vertex_lists = []
+    for color, (mode, vertices, indices) in geometry:
+        n = len(vertices) // 2
+        colors = color_transform(color) * n
+        if indices is None:
+            vertex_list = batch.add(n, mode, None,
+                                    ('v2f', vertices), ('c3f', colors))
+        else:
+            vertex_list = batch.add_indexed(n, mode, None, indices,
+                                            ('v2f', vertices), ('c3f', colors))
+        vertex_lists.append(vertex_list)
+    return vertex_lists
+
+def bounding_circle(geometry):
+    """ A circle around body geometry, as center x, y and radius. """
+    bounds = None
+    for color, (mode, vertices, indices) in geometry:
+        bounds = union_bounds(bounds, vertex_bounds(vertices))
+    cx, cy = (bounds[0] + bounds[2]) / 2, (bounds[1] + bounds[3]) / 2
+    r = 0.0
+    for color, (mode, vertices, indices) in geometry:
+        for i in xrange(0, len(vertices), 2):
+            r = max(r, math.hypot(vertices[i] - cx, vertices[i + 1] - cy))
+    return cx, cy, r
+
+def circle_bounds(circle, position, angle):
+    """ The box around a bounding circle of a body at a pose. """
+    cx, cy, r = circle
+    x, y = position
+    c, s = math.cos(angle), math.sin(angle)
+    x, y = x + c * cx - s * cy, y + s * cx + c * cy
+    return x - r, y - r, x + r, y + r
+
+def vertex_bounds(vertices):
+    xs, ys = vertices[0::2], vertices[1::2]
+    return min(xs), min(ys), max(xs), max(ys)
+
+def union_bounds(a, b):
+    if a is None:
+        return b
+    return min(a[0], b[0]), min(a[1], b[1]), max(a[2], b[2]), max(a[3], b[3])
+
+def intersects(a, b):
+    return a[0] <= b[2] and b[0] <= a[2] and a[1] <= b[3] and b[1] <= a[3]
+
+class BodyEntry(object):
+    """ What the renderer knows about a body. """
+    def __init__(self, body, body_data, order):
+        self.body = body
+        self.body_data = body_data
+        # Moving bodies are drawn in the order they were first seen.
+        self.order = order
+        self.vertex_lists = []
+        self.vertex_count = 0
+        # Static bodies: the grid cell that draws them.
+        self.cell = None
+        # Moving bodies: a batch of their own, the bounding circle of their
+        # shapes in body coordinates and the grid cells they cover.
+        self.batch = None
+        self.local_bounds = None
+        self.cells = ()
+        # Moving bodies: (x, y, angle) before the last step, if the body
+        # existed then.
+        self.previous_pose = None
+
+class StaticCell(object):
+    """ The static bodies of a grid cell, drawn as one batch. """
+    def __init__(self):
+        self.batch = pyglet.graphics.Batch()
+        self.bounds = None
+        self.bodies = 0
+        self.vertex_count = 0
+
+class WorldRenderer(object):
+    """
+    Draws the world of a sim from vertex lists, skipping everything that
+    is outside the view. The shapes of a body are uploaded the first time
+    the body is seen.
+
+    Static bodies are baked into world coordinates and batched per cell of
+    a uniform grid. They are never indexed again; a cell is drawn when the
+    bounds of its bodies intersect the view. Moving bodies have a batch
+    each and are kept in the same grid, re-indexed only while awake.
+    """
+    GRID_CELLS = 16
+
+    def __init__(self, sim, color_transform=lambda x:x, pixels_per_unit=1.0):
+        self.sim = sim
+        self.color_transform = color_transform
+        self.level = lod_level(pixels_per_unit)
+        self.cell_size = max(sim.width, sim.height) / float(self.GRID_CELLS)
+        self.reset()
+        # Counts of the last draw().
+        self.drawn = 0
+        self.culled = 0
+        self.vertex_count = 0
+
+    def reset(self):
+        # id(body user data) -> BodyEntry
+        self.bodies = {}
+        self.static_cells = defaultdict(StaticCell)
+        self.moving = []
+        self.moving_grid = defaultdict(set)
+        self.next_order = 0
+        # The Sim.body_generation the bodies are in sync with.
+        self.body_generation = None
+
+    def set_sim(self, sim):
+        """ Draws another sim of the same level from now on. """
+        self.clear()
+        self.sim = sim
+
+    def set_scale(self, pixels_per_unit):
+        """
+        Picks the tessellations for a new zoom. All bodies are uploaded
+        again from their precomputed tessellations on the next draw().
+        """
+        level = lod_level(pixels_per_unit)
+        if level != self.level:
+            self.level = level
+            self.clear()
+
+    def clear(self):
+        for entry in self.bodies.itervalues():
+            for vertex_list in entry.vertex_lists:
+                vertex_list.delete()
+        self.reset()
+
+    def cell_of(self, x, y):
+        return int(x // self.cell_size), int(y // self.cell_size)
+
+    def cells_in(self, bounds):
+        (x0, y0), (x1, y1) = (self.cell_of(*bounds[:2]),
+                              self.cell_of(*bounds[2:]))
+        return [(x, y) for x in xrange(x0, x1 + 1) for y in xrange(y0, y1 + 1)]
+
+    def add_body(self, body, body_data):
+        self.next_order += 1
+        entry = BodyEntry(body, body_data, self.next_order)
+        is_static = body.IsStatic()
+        if is_static:
+            position, angle = body.GetPosition().tuple(), body.GetAngle()
+            geometry = []
+            for color, (mode, vertices, indices) in \
+                    body_geometry(body_data, self.level):
+                vertices = transform_vertices(vertices, position, angle)
+                geometry.append((color, (mode, vertices, indices)))
+            bounds = None
+            for color, (mode, vertices, indices) in geometry:
+                bounds = union_bounds(bounds, vertex_bounds(vertices))
+            if bounds is None:
+                # Nothing visible.
+                self.bodies[id(body_data)] = entry
+                return
+            center = (bounds[0] + bounds[2]) / 2, (bounds[1] + bounds[3]) / 2
+            entry.cell = cell = self.static_cells[self.cell_of(*center)]
+            cell.bounds = union_bounds(cell.bounds, bounds)
+            cell.bodies += 1
+            batch = cell.batch
+        else:
+            geometry = list(body_geometry(body_data, self.level))
+            entry.batch = batch = pyglet.graphics.Batch()
+            if geometry:
+                entry.local_bounds = bounding_circle(geometry)
+            self.moving.append(entry)
+
+        entry.vertex_lists = add_geometry(batch, geometry,
+                                          self.color_transform)
+        entry.vertex_count = sum(v.get_size() for v in entry.vertex_lists)
+        if entry.cell is not None:
+            entry.cell.vertex_count += entry.vertex_count
+        self.bodies[id(body_data)] = entry
+
+    def remove_body(self, key):
+        entry = self.bodies.pop(key)
+        for vertex_list in entry.vertex_lists:
+            vertex_list.delete()
+        if entry.cell is not None:
+            entry.cell.bodies -= 1
+            entry.cell.vertex_count -= entry.vertex_count
+        if entry.batch is not None:
+            self.moving.remove(entry)
+            for cell in entry.cells:
+                self.moving_grid[cell].discard(entry)
+
+    def sync_bodies(self):
+        """ Picks up bodies that have been created or destroyed. """
+        alive = set()
+        for body in self.sim.world:
+            body_data = body.GetUserData()
+            if not body_data:
+                continue
+            key = id(body_data)
+            if key not in self.bodies:
+                self.add_body(body, body_data)
+            alive.add(key)
+        for key in set(self.bodies) - alive:
+            self.remove_body(key)
+        self.body_generation = self.sim.body_generation
+
+    def moving_bounds(self, entry):
+        return circle_bounds(entry.local_bounds,
+                             entry.body.GetPosition().tuple(),
+                             entry.body.GetAngle())
+
+    def save_poses(self):
+        """ Remembers the poses of moving bodies before a step. """
+        for entry in self.moving:
+            body = entry.body
+            x, y = body.GetPosition().tuple()
+            entry.previous_pose = x, y, body.GetAngle()
+
+    def pose(self, entry, alpha):
+        """ The pose of a moving body, alpha of the way into the last step. """
+        x, y = entry.body.GetPosition().tuple()
+        angle = entry.body.GetAngle()
+        if entry.previous_pose is None or alpha >= 1.0:
+            return x, y, angle
+        px, py, pangle = entry.previous_pose
+        return (px + (x - px) * alpha, py + (y - py) * alpha,
+                pangle + (angle - pangle) * alpha)
+
+    def index_moving(self):
+        for entry in self.moving:
+            if not entry.local_bounds:
+                continue
+            if entry.cells and entry.body.IsSleeping():
+                continue
+            cells = self.cells_in(self.moving_bounds(entry))
+            if cells != entry.cells:
+                for cell in entry.cells:
+                    self.moving_grid[cell].discard(entry)
+                for cell in cells:
+                    self.moving_grid[cell].add(entry)
+                entry.cells = cells
+
+    def draw(self, view, alpha=1.0):
+        """
+        Draws what intersects view, a (left, bottom, right, top) box.
+        Moving bodies are drawn alpha of the way from their previous pose
+        to their current one.
+        """
+        if self.body_generation != self.sim.body_generation:
+            self.sync_bodies()
+        self.index_moving()
+
+        drawn = vertex_count = 0
+        for cell in self.static_cells.itervalues():
+            if cell.bodies and intersects(cell.bounds, view):
+                cell.batch.draw()
+                drawn += cell.bodies
+                vertex_count += cell.vertex_count
+
+        visible = set()
+        for cell in self.cells_in(view):
+            visible.update(self.moving_grid.get(cell, ()))
+        for entry in sorted(visible, key=lambda e: e.order):
+            x, y, angle = self.pose(entry, alpha)
+            if not intersects(circle_bounds(entry.local_bounds, (x, y), angle),
+                              view):
+                continue
+            glPushMatrix()
+            glTranslatef(x, y, 0.0)
+            glRotatef(math.degrees(angle), 0.0, 0.0, 1.0)
+            entry.batch.draw()
+            glPopMatrix()
+            drawn += 1
+            vertex_count += entry.vertex_count
+
+        self.drawn = drawn
+        self.culled = len(self.bodies) - drawn
+        self.vertex_count = vertex_count
+
+class GhostRenderer(object):
+    """
+    Draws a ghost from a precomputed pose track, so no physics runs for
+    it. Only the moving bodies are drawn; the shapes come from a template
+    sim that has every body of the level created.
+    """
+    def __init__(self, template_sim, track, color_transform=lambda x:x,
+                 pixels_per_unit=1.0):
+        self.template_sim = template_sim
+        self.track = track
+        self.color_transform = color_transform
+        self.level = lod_level(pixels_per_unit)
+        # body index in track -> (batch, vertex lists, bounding circle)
+        self.bodies = {}
+        self.vertex_count = 0
+
+    def set_scale(self, pixels_per_unit):
+        level = lod_level(pixels_per_unit)
+        if level != self.level:
+            self.level = level
+            self.clear()
+
+    def clear(self):
+        for batch, vertex_lists, circle in self.bodies.itervalues():
+            for vertex_list in vertex_lists:
+                vertex_list.delete()
+        self.bodies = {}
+
+    def add_body(self, index):
+        body = self.template_sim.find_body(self.track.body_ids[index])
+        geometry = []
+        if body:
+            geometry = list(body_geometry(body.GetUserData(), self.level))
+        batch = pyglet.graphics.Batch()
+        vertex_lists = add_geometry(batch, geometry, self.color_transform)
+        circle = bounding_circle(geometry) if geometry else None
+        self.bodies[index] = batch, vertex_lists, circle
+        return self.bodies[index]
+
+    def draw(self, step, view, alpha=1.0):
+        """ Draws the ghost after step steps, alpha into the last one. """
+        vertex_count = 0
+        for index, x, y, angle in self.track.poses_between(step, alpha):
+            if index in self.bodies:
+                batch, vertex_lists, circle = self.bodies[index]
+            else:
+                batch, vertex_lists, circle = self.add_body(index)
+            if not circle or \
+               not intersects(circle_bounds(circle, (x, y), angle), view):
+                continue
+            glPushMatrix()
+            glTranslatef(x, y, 0.0)
+            glRotatef(math.degrees(angle), 0.0, 0.0, 1.0)
+            batch.draw()
+            glPopMatrix()
+            vertex_count += sum(v.get_size() for v in vertex_lists)
+        self.vertex_count = vertex_count
+
+def gray_scale(color):
+    c = sum(color) / 3.0
+    return c,c,c
+
+class SimWindow(pyglet.window.Window):
+    WINDOW_SIDE = 400
+    GHOST_COLOR_DAMPING = 0.4
+    # At most this many steps are taken per update. Time beyond that is
+    # dropped, and the game runs slower instead of falling further behind.
+    MAX_SUBSTEPS = 5
+    # How often the profiler overlay is rewritten, in seconds.
+    HUD_INTERVAL = 0.5
+    
+    def __init__(self, sim, viewport, background, log_stream=None, 
+                 replay_stream=None,
+                 ghosts=[],
+                 sounds=[], caption='sim', max_substeps=MAX_SUBSTEPS,
+                 profiler=None, template=None, retry=False):
+        # The renderers must exist before the window, which may dispatch
+        # on_resize while it is created.
+        (x, y), (w, h) = viewport
+        self.viewport_model_height = h
+        pixels_per_unit = self.WINDOW_SIDE / h
+        self.renderer = WorldRenderer(sim, pixels_per_unit=pixels_per_unit)
+        # One renderer per (template sim, pose track) ghost.
+        self.ghost_renderers = [GhostRenderer(template_sim, track,
+                                              gray_scale, pixels_per_unit)
+                                for template_sim, track in ghosts]
+        pyglet.window.Window.__init__(self,
+                                      width=self.WINDOW_SIDE,
+                                      height=self.WINDOW_SIDE,
+                                      resizable=True,
+                                      caption=caption)
+        self.sim = sim
+        # The sim.LevelTemplate to restart the level from, and whether to
+        # restart it automatically on game over.
+        self.template = template
+        self.retry = retry
+        self.log_stream = log_stream
+        self.replay_stream = replay_stream
+        self.time = 0
+        self.max_substeps = max_substeps
+        # Time that could not be simulated in real time, and the number of
+        # updates that dropped some.
+        self.dropped_time = 0.0
+        self.dropped_updates = 0
+        self.previous_ship_position = None
+        # Phase timing is off while profiler is None. P turns it on and
+        # shows the overlay.
+        self.set_profiler(profiler)
+        self.hud = None
+        self.hud_updated = 0.0
+        self.last_frame = None
+        self.background = background + (1.0,)
+        self.start_camera_position = (x + w/2, y + h/2)
+        self.camera_position = self.start_camera_position
+        pyglet.clock.schedule_interval(self.update, 1 / 60.0)
+
+        # Sounds are decoded in the background and picked up every clock
+        # tick once the first frame is drawn, so the level starts without
+        # waiting for them.
+        # signal -> (file name, source) of the sounds that are ready.
+        self.triggered_sounds = {}
+        # Signals that were emitted before their sound was ready.
+        self.late_signals = set()
+        self.sound_signals = set(started_by for sound_file, started_by
+                                 in sounds if started_by)
+        self.sound_loader = SoundLoader()
+        self.first_frame_drawn = False
+        for sound_file, started_by in sounds:
+            self.load_sound(sound_file, started_by)
+
+        sim.external_signal_listener = self.sim_signal
+        sim.game_end_listener = self.sim_game_end
+
+    def restart(self, dt=None):
+        """ Starts the level again, with a new sim from the template. """
+        sim, _, _, _ = self.template.make_sim()
+        # Keys that are held down keep steering.
+        sim.ship.thrust = self.sim.ship.thrust
+        sim.ship.turn_direction = self.sim.ship.turn_direction
+        sim.external_signal_listener = self.sim_signal
+        sim.game_end_listener = self.sim_game_end
+        sim.profiler = self.profiler
+        self.sim = sim
+        self.renderer.set_sim(sim)
+        self.time = 0
+        self.previous_ship_position = None
+        self.camera_position = self.start_camera_position
+        self.late_signals.clear()
+        if self.log_stream:
+            self.log_stream.clear()
+
+    def set_profiler(self, profiler):
+        self.profiler = profiler
+        self.sim.profiler = profiler
+
+    def toggle_hud(self):
+        if self.hud:
+            self.hud = None
+            return
+        if not self.profiler:
+            self.set_profiler(Profiler())
+        self.hud = pyglet.text.Label('', font_name='Courier New', font_size=8,
+                                     x=5, y=self.height - 5, anchor_y='top',
+                                     multiline=True, width=self.width - 10)
+        self.hud_updated = 0.0
+
+    def draw_hud(self):
+        now = timer()
+        if now - self.hud_updated > self.HUD_INTERVAL:
+            self.hud.text = self.profiler.report()
+            self.hud_updated = now
+        self.hud.y = self.height - 5
+        glMatrixMode(GL_PROJECTION)
+        glLoadIdentity()
+        glOrtho(0, self.width, 0, self.height, -1.0, 1.0)
+        glMatrixMode(GL_MODELVIEW)
+        self.hud.draw()
+
+    def load_sound(self, sound_file, started_by):
+        self.sound_loader.load(sound_file, started_by)
+        if self.first_frame_drawn:
+            self.schedule_sound_loading()
+
+    def schedule_sound_loading(self):
+        pyglet.clock.unschedule(self.poll_sounds)
+        pyglet.clock.schedule(self.poll_sounds)
+
+    def poll_sounds(self, dt):
+        for sound_file, started_by, sound, error in self.sound_loader.poll():
+            if error:
+                print >> sys.stderr, 'Could not load %s: %s' % (sound_file,
+                                                               error)
+            elif not started_by:
+                # Start all sounds that are not started by a sim signal.
+                sound.play()
+            else:
+                self.triggered_sounds[started_by] = sound_file, sound
+                if started_by in self.late_signals:
+                    self.late_signals.discard(started_by)
+                    self.sim_signal(started_by)
+        if not self.sound_loader.pending:
+            pyglet.clock.unschedule(self.poll_sounds)
+
+    def sim_signal(self, signal):
+        if signal in self.triggered_sounds:
+            sound_file, sound = self.triggered_sounds[signal]
+            sound.play()
+            if is_streaming(sound):
+                # A streaming source plays once; open it again for the
+                # next time.
+                del self.triggered_sounds[signal]
+                self.load_sound(sound_file, signal)
+        elif signal in self.sound_signals:
+            self.late_signals.add(signal)
+
+    def sim_game_end(self, status):
+        if self.retry and self.template and not self.replay_stream and \
+           status is self.sim.GAME_OVER:
+            # Not while the old sim is stepping.
+            pyglet.clock.schedule_once(self.restart, 0)
+        else:
+            pyglet.app.exit()
+
+    def on_resize(self, width, height):
+        glViewport(0, 0, width, height)
+        pixels_per_unit = max(width, height) / self.viewport_model_height
+        self.renderer.set_scale(pixels_per_unit)
+        for ghost_renderer in self.ghost_renderers:
+            ghost_renderer.set_scale(pixels_per_unit)
+
+    def update(self, dt):
+        if self.profiler:
+            t0 = timer()
+            self.update_steps(dt)
+            self.profiler.add('update', timer() - t0)
+        else:
+            self.update_steps(dt)
+
+    def update_steps(self, dt):
+        self.time += dt
+        time_step = self.sim.time_step
+        steps = int(self.time / time_step)
+        if steps > self.max_substeps:
+            dropped = (steps - self.max_substeps) * time_step
+            self.time -= dropped
+            self.dropped_time += dropped
+            self.dropped_updates += 1
+            steps = self.max_substeps
+        def steer_by_stream(ship, stream):
+            ship.thrust, ship.turn_direction = stream.next()
+        for i in xrange(steps):
+            if self.sim.game_end_status:
+                # The game end was handled when it happened. A retry
+                # replaces the sim on the next tick; until then it stands
+                # still.
+                break
+            self.time -= time_step
+            if i == steps - 1:
+                # Rendering interpolates from the poses before the last
+                # step.
+                self.renderer.save_poses()
+                self.previous_ship_position = self.sim.ship.position
+            if self.replay_stream:
+                try:
+                    steer_by_stream(self.sim.ship, self.replay_stream)
+                except StopIteration:
+                    pyglet.app.exit()
+                    break
+            if self.log_stream:
+                self.log_stream.append(self.sim.ship.thrust,
+                                       self.sim.ship.turn_direction)
+            self.sim.step()
+
+    def interpolation_alpha(self):
+        """ How far real time is into the step after the last one taken. """
+        return max(0.0, min(1.0, self.time / self.sim.time_step))
+
+    def ship_position(self, alpha):
+        x, y = self.sim.ship.position
+        if self.previous_ship_position is None:
+            return x, y
+        px, py = self.previous_ship_position
+        return px + (x - px) * alpha, py + (y - py) * alpha
+
+    def update_camera_position(self, alpha):
+        max_distance = self.viewport_model_height/6
+        new_camera = []
+        for cam, ship in zip(self.camera_position, self.ship_position(alpha)):
+            distance = ship - cam
+            if distance > max_distance:
+                cam += (distance - max_distance)
+            elif distance < -max_distance:
+                cam += (distance + max_distance)
+            new_camera.append(cam)
+        self.camera_position = tuple(new_camera)
+        
+    def on_draw(self):
+        profiler = self.profiler
+        if profiler:
+            t0 = timer()
+            if self.last_frame is not None:
+                profiler.add('frame', t0 - self.last_frame)
+            self.last_frame = t0
+        alpha = self.interpolation_alpha()
+        self.update_camera_position(alpha)
+        glMatrixMode(GL_PROJECTION)
+        glLoadIdentity()
+        glOrtho(self.camera_position[0] - self.viewport_model_height/2,
+                self.camera_position[0] + self.viewport_model_height/2,
+                self.camera_position[1] - self.viewport_model_height/2,
+                self.camera_position[1] + self.viewport_model_height/2,
+                -1.0, 1.0)
+        glMatrixMode(GL_MODELVIEW)
+
+        #glClearColor(0.3, 0.3, 0.4, 1.0)
+        glClearColor(*self.background)
+        self.clear()
+        x, y = self.camera_position
+        half = self.viewport_model_height/2
+        view = x - half, y - half, x + half, y + half
+        if profiler:
+            t1 = timer()
+        # Ghosts are as far into their runs as the player.
+        for ghost_renderer in self.ghost_renderers:
+            ghost_renderer.draw(self.sim.steps_taken, view, alpha)
+        if profiler:
+            t2 = timer()
+        self.renderer.draw(view, alpha)
+        if profiler:
+            t3 = timer()
+            profiler.add('draw.setup', t1 - t0)
+            profiler.add('draw.ghosts', t2 - t1)
+            profiler.add('draw.world', t3 - t2)
+            profiler.add_counter('ghosts.vertices',
+                                 sum(ghost_renderer.vertex_count for
+                                     ghost_renderer in self.ghost_renderers))
+            profiler.add_counter('world.vertices', self.renderer.vertex_count)
+            profiler.add_counter('world.drawn', self.renderer.drawn)
+            profiler.add_counter('world.culled', self.renderer.culled)
+        if self.hud:
+            self.draw_hud()
+        if not self.first_frame_drawn:
+            self.first_frame_drawn = True
+            if self.sound_loader.pending:
+                self.schedule_sound_loading()
+
+    def on_key_press(self, symbol, modifiers):
+        if symbol == pyglet.window.key.P:
+            self.toggle_hud()
+        else:
+            self.control_key_press(symbol)
+
+    def control_key_press(self, symbol):
+        # If not in replay, respond to ship controls.
+        if not self.replay_stream:
+            if symbol == pyglet.window.key.UP:
+                self.sim.ship.thrust = True
+            elif symbol == pyglet.window.key.LEFT:
+                self.sim.ship.turn_direction = 1
+            elif symbol == pyglet.window.key.RIGHT:
+                self.sim.ship.turn_direction = -1
+            elif symbol == pyglet.window.key.F:
+                self.set_fullscreen(not self.fullscreen)
+            elif symbol == pyglet.window.key.R and self.template:
+                self.restart()
+            elif symbol == pyglet.window.key.ESCAPE:
+                pyglet.app.exit()
+
+    def on_key_release(self, symbol, modifiers):
+        # If not in replay, respond to ship controls.
+        if not self.replay_stream:
+            if symbol == pyglet.window.key.UP:
+                self.sim.ship.thrust = False
+            elif symbol in [pyglet.window.key.LEFT, pyglet.window.key.RIGHT]:
+                self.sim.ship.turn_direction = 0